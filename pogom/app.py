@@ -4,18 +4,22 @@
 import calendar
 import logging
 
-from flask import Flask, abort, jsonify, render_template, request
+from flask import Flask, Response, abort, json, jsonify, render_template, request, stream_with_context
 from flask.json import JSONEncoder
 from flask_compress import Compress
 from datetime import datetime
-from s2sphere import LatLng
 from pogom.utils import get_args
 from datetime import timedelta
 from collections import OrderedDict
+from itertools import chain
+from queue import Empty
 
 from . import config
-from .models import Pokemon, Gym, Pokestop, ScannedLocation, MainWorker, WorkerStatus
-from .utils import now
+from .models import Pokemon, Gym, Pokestop, ScannedLocation, SpawnPoint, MainWorker, WorkerStatus, response_cache, stream_broker, \
+    set_db_role
+from .cache import gzip_fragment, join_fragment
+from .jsonstream import JSONStreamer, gzip_stream
+from .utils import now, get_pokemon_name
 log = logging.getLogger(__name__)
 compress = Compress()
 
@@ -25,8 +29,16 @@ class Pogom(Flask):
         super(Pogom, self).__init__(import_name, **kwargs)
         compress.init_app(self)
         self.json_encoder = CustomJSONEncoder
+        response_cache.set_ttl(get_args().raw_data_cache)
+        stream_broker.json_encoder = CustomJSONEncoder
+        self.json_streamer = JSONStreamer(CustomJSONEncoder)
+        # Registered before the database hooks, so requests connect to the
+        # read pool and close it again before the role is reset.
+        self.before_request(self.use_read_role)
+        self.teardown_request(self.reset_db_role)
         self.route("/", methods=['GET'])(self.fullmap)
         self.route("/raw_data", methods=['GET'])(self.raw_data)
+        self.route("/stream", methods=['GET'])(self.stream)
         self.route("/loc", methods=['GET'])(self.loc)
         self.route("/next_loc", methods=['POST'])(self.next_loc)
         self.route("/mobile", methods=['GET'])(self.list_pokemon)
@@ -37,6 +49,16 @@ class Pogom(Flask):
         self.route("/status", methods=['POST'])(self.post_status)
         self.route("/gym_data", methods=['GET'])(self.get_gymdata)
 
+    def use_read_role(self):
+        # Polls for what changed since their timestamp stay on the primary. A
+        # row a lagging replica doesn't have yet would be older than the
+        # timestamp of the next poll, and never be sent.
+        if not request.args.get('timestamp'):
+            set_db_role('read')
+
+    def reset_db_role(self, exc):
+        set_db_role(None)
+
     def set_search_control(self, control):
         self.search_control = control
 
@@ -119,13 +141,6 @@ class Pogom(Flask):
         oNeLat = request.args.get('oNeLat')
         oNeLng = request.args.get('oNeLng')
 
-        # Previous switch settings.
-        lastgyms = request.args.get('lastgyms')
-        lastpokestops = request.args.get('lastpokestops')
-        lastpokemon = request.args.get('lastpokemon')
-        lastslocs = request.args.get('lastslocs')
-        lastspawns = request.args.get('lastspawns')
-
         if request.args.get('luredonly', 'true') == 'true':
             luredonly = True
         else:
@@ -161,6 +176,77 @@ class Pogom(Flask):
         d['oNeLat'] = neLat
         d['oNeLng'] = neLng
 
+        if self.raw_data_cacheable(newArea):
+            return self.cached_raw_data(d, swLat, swLng, neLat, neLng, timestamp, luredonly)
+
+        layers = self.get_map_layers(swLat, swLng, neLat, neLng, timestamp, luredonly,
+                                     newArea, oSwLat, oSwLng, oNeLat, oNeLng)
+
+        selected_duration = None
+
+        # for stats and changed nest points etc, limit pokemon queried.
+        for duration in self.get_valid_stat_input()["duration"]["items"].values():
+            if duration["selected"] == "SELECTED":
+                selected_duration = duration["value"]
+                break
+
+        if request.args.get('seen', 'false') == 'true':
+            d['seen'] = Pokemon.get_seen(selected_duration)
+
+        if request.args.get('appearances', 'false') == 'true':
+            d['appearances'] = Pokemon.get_appearances(request.args.get('pokemonid'), selected_duration)
+
+        if request.args.get('appearancesDetails', 'false') == 'true':
+            d['appearancesTimes'] = Pokemon.get_appearances_times_by_spawnpoint(request.args.get('pokemonid'),
+                                                                                request.args.get('spawnpoint_id'),
+                                                                                selected_duration)
+
+        if request.args.get('status', 'false') == 'true':
+            args = get_args()
+            d = {}
+            if args.status_page_password is None:
+                d['error'] = 'Access denied'
+            elif request.args.get('password', None) == args.status_page_password:
+                d['main_workers'] = MainWorker.get_all()
+                d['workers'] = WorkerStatus.get_all()
+            return jsonify(d)
+
+        return self.streamed_json(d, layers)
+
+    # Send the map layers as they are read and serialized, instead of
+    # building the whole response first. The request context is kept around
+    # until the layers have been read.
+    def streamed_json(self, head, layers):
+        chunks = self.json_streamer.iterencode(head, layers)
+        if 'gzip' in request.headers.get('Accept-Encoding', '').lower():
+            # Compressed here as it streams, Flask-Compress leaves it be.
+            response = self.response_class(stream_with_context(gzip_stream(chunks)),
+                                           mimetype='application/json')
+            response.headers['Content-Encoding'] = 'gzip'
+            response.headers['Vary'] = 'Accept-Encoding'
+            return response
+
+        return self.response_class(stream_with_context(chunks), mimetype='application/json')
+
+    # Returns {key: rows}, the Pokemon rows are read lazily and come without
+    # their species fields.
+    def get_map_layers(self, swLat, swLng, neLat, neLng, timestamp, luredonly,
+                       newArea=False, oSwLat=None, oSwLng=None, oNeLat=None, oNeLng=None):
+        d = {}
+
+        # Previous switch settings.
+        lastgyms = request.args.get('lastgyms')
+        lastpokestops = request.args.get('lastpokestops')
+        lastpokemon = request.args.get('lastpokemon')
+        lastslocs = request.args.get('lastslocs')
+        lastspawns = request.args.get('lastspawns')
+
+        # Incremental updates return what changed since the last request and
+        # what the move uncovered, in a single query per layer.
+        old = {}
+        if newArea:
+            old = {'oSwLat': oSwLat, 'oSwLng': oSwLng, 'oNeLat': oNeLat, 'oNeLng': oNeLng}
+
         if request.args.get('pokemon', 'true') == 'true':
             if request.args.get('ids'):
                 ids = [int(x) for x in request.args.get('ids').split(',')]
@@ -168,84 +254,151 @@ class Pogom(Flask):
                                                          neLat, neLng)
             elif lastpokemon != 'true':
                 # If this is first request since switch on, load all pokemon on screen.
-                d['pokemons'] = Pokemon.get_active(swLat, swLng, neLat, neLng)
+                d['pokemons'] = Pokemon.iter_active(swLat, swLng, neLat, neLng)
             else:
-                # If map is already populated only request modified Pokemon since last request time.
-                d['pokemons'] = Pokemon.get_active(swLat, swLng, neLat, neLng, timestamp=timestamp)
-                if newArea:
-                    # If screen is moved add newly uncovered Pokemon to the ones that were modified since last request time.
-                    d['pokemons'] = d['pokemons'] + (Pokemon.get_active(swLat, swLng, neLat, neLng, oSwLat=oSwLat, oSwLng=oSwLng, oNeLat=oNeLat, oNeLng=oNeLng))
+                # If map is already populated only request modified Pokemon since last request time,
+                # plus the newly uncovered ones if the screen was moved.
+                d['pokemons'] = Pokemon.iter_active(swLat, swLng, neLat, neLng, timestamp=timestamp, **old)
 
             if request.args.get('eids'):
                 # Exclude id's of pokemon that are hidden.
-                eids = [int(x) for x in request.args.get('eids').split(',')]
-                d['pokemons'] = [x for x in d['pokemons'] if x['pokemon_id'] not in eids]
+                eids = set(int(x) for x in request.args.get('eids').split(','))
+                d['pokemons'] = (x for x in d['pokemons'] if x['pokemon_id'] not in eids)
 
             if request.args.get('reids'):
                 reids = [int(x) for x in request.args.get('reids').split(',')]
-                d['pokemons'] = d['pokemons'] + (Pokemon.get_active_by_id(reids, swLat, swLng, neLat, neLng))
+                d['pokemons'] = chain(d['pokemons'], Pokemon.get_active_by_id(reids, swLat, swLng, neLat, neLng))
                 d['reids'] = reids
 
         if request.args.get('pokestops', 'true') == 'true':
             if lastpokestops != 'true':
                 d['pokestops'] = Pokestop.get_stops(swLat, swLng, neLat, neLng, lured=luredonly)
             else:
-                d['pokestops'] = Pokestop.get_stops(swLat, swLng, neLat, neLng, timestamp=timestamp)
-                if newArea:
-                    d['pokestops'] = d['pokestops'] + (Pokestop.get_stops(swLat, swLng, neLat, neLng, oSwLat=oSwLat, oSwLng=oSwLng, oNeLat=oNeLat, oNeLng=oNeLng, lured=luredonly))
+                d['pokestops'] = Pokestop.get_stops(swLat, swLng, neLat, neLng, timestamp=timestamp, lured=luredonly, **old)
 
         if request.args.get('gyms', 'true') == 'true':
             if lastgyms != 'true':
                 d['gyms'] = Gym.get_gyms(swLat, swLng, neLat, neLng)
             else:
-                d['gyms'] = Gym.get_gyms(swLat, swLng, neLat, neLng, timestamp=timestamp)
-                if newArea:
-                    d['gyms'].update(Gym.get_gyms(swLat, swLng, neLat, neLng, oSwLat=oSwLat, oSwLng=oSwLng, oNeLat=oNeLat, oNeLng=oNeLng))
+                d['gyms'] = Gym.get_gyms(swLat, swLng, neLat, neLng, timestamp=timestamp, **old)
 
         if request.args.get('scanned', 'true') == 'true':
             if lastslocs != 'true':
                 d['scanned'] = ScannedLocation.get_recent(swLat, swLng, neLat, neLng)
             else:
-                d['scanned'] = ScannedLocation.get_recent(swLat, swLng, neLat, neLng, timestamp=timestamp)
-                if newArea:
-                    d['scanned'] = d['scanned'] + (ScannedLocation.get_recent(swLat, swLng, neLat, neLng, oSwLat=oSwLat, oSwLng=oSwLng, oNeLat=oNeLat, oNeLng=oNeLng))
-
-        selected_duration = None
-
-        # for stats and changed nest points etc, limit pokemon queried.
-        for duration in self.get_valid_stat_input()["duration"]["items"].values():
-            if duration["selected"] == "SELECTED":
-                selected_duration = duration["value"]
-                break
-
-        if request.args.get('seen', 'false') == 'true':
-            d['seen'] = Pokemon.get_seen(selected_duration)
-
-        if request.args.get('appearances', 'false') == 'true':
-            d['appearances'] = Pokemon.get_appearances(request.args.get('pokemonid'), selected_duration)
-
-        if request.args.get('appearancesDetails', 'false') == 'true':
-            d['appearancesTimes'] = Pokemon.get_appearances_times_by_spawnpoint(request.args.get('pokemonid'),
-                                                                                request.args.get('spawnpoint_id'),
-                                                                                selected_duration)
+                d['scanned'] = ScannedLocation.get_recent(swLat, swLng, neLat, neLng, timestamp=timestamp, **old)
 
         if request.args.get('spawnpoints', 'false') == 'true':
             if lastspawns != 'true':
-                d['spawnpoints'] = Pokemon.get_spawnpoints(swLat=swLat, swLng=swLng, neLat=neLat, neLng=neLng)
+                d['spawnpoints'] = SpawnPoint.get_spawnpoints(swLat=swLat, swLng=swLng, neLat=neLat, neLng=neLng)
             else:
-                d['spawnpoints'] = Pokemon.get_spawnpoints(swLat=swLat, swLng=swLng, neLat=neLat, neLng=neLng, timestamp=timestamp)
-                if newArea:
-                    d['spawnpoints'] = d['spawnpoints'] + (Pokemon.get_spawnpoints(swLat, swLng, neLat, neLng, oSwLat=oSwLat, oSwLng=oSwLng, oNeLat=oNeLat, oNeLng=oNeLng))
+                d['spawnpoints'] = SpawnPoint.get_spawnpoints(swLat=swLat, swLng=swLng, neLat=neLat, neLng=neLng, timestamp=timestamp, **old)
+
+        return d
+
+    # Plain map polls can be answered from the shared cache. Anything asking
+    # for specific ids, statistics or a newly uncovered area goes to the db.
+    def raw_data_cacheable(self, newArea):
+        if response_cache.ttl <= 0 or newArea:
+            return False
+        if not all(request.args.get(k) for k in ('swLat', 'swLng', 'neLat', 'neLng')):
+            return False
+        if request.args.get('ids') or request.args.get('reids'):
+            return False
+        for k in ('seen', 'appearances', 'appearancesDetails', 'status'):
+            if request.args.get(k, 'false') == 'true':
+                return False
+        return True
+
+    def cached_raw_data(self, d, swLat, swLng, neLat, neLng, timestamp, luredonly):
+        # Snap the viewport to the tile grid and the timestamp to a bucket, so
+        # clients looking at the same area share entries. They get a few rows
+        # outside their view or already sent, which the map ignores.
+        bounds = response_cache.snap(swLat, swLng, neLat, neLng)
+        layers = (('pokemon', 'true', 'lastpokemon'),
+                  ('pokestops', 'true', 'lastpokestops'),
+                  ('gyms', 'true', 'lastgyms'),
+                  ('scanned', 'true', 'lastslocs'),
+                  ('spawnpoints', 'false', 'lastspawns'))
+        toggles = tuple((request.args.get(k, default), request.args.get(last))
+                        for k, default, last in layers)
+        if any(last == 'true' for toggle, last in toggles):
+            timestamp = response_cache.bucket(timestamp)
+        else:
+            timestamp = 0
+        eids = request.args.get('eids')
+        if eids:
+            eids = tuple(sorted(set(int(x) for x in eids.split(','))))
+
+        key = (bounds, toggles, luredonly, eids, timestamp)
+        entry = response_cache.get(key, bounds)
+        if entry is None:
+            version = response_cache.version()
+            computed_at = datetime.utcnow()
+            # Passed on as strings like the request args, 0.0 is a valid bound.
+            swLat, swLng, neLat, neLng = [str(x) for x in bounds]
+            layers = self.get_map_layers(swLat, swLng, neLat, neLng, timestamp, luredonly)
+            fragment = ''.join(self.json_streamer.iterencode_layers(layers))
+            entry = response_cache.put(key, version, computed_at, fragment)
+        computed_at, fragment, deflated = entry
+
+        # Rows committed after the entry was built are picked up by the next
+        # poll, as long as the client carries on from the entry's time.
+        d['timestamp'] = computed_at
+        head = json.dumps(d)
+
+        if 'gzip' in request.headers.get('Accept-Encoding', '').lower():
+            response = self.response_class(gzip_fragment(head, fragment, deflated),
+                                           mimetype='application/json')
+            response.headers['Content-Encoding'] = 'gzip'
+            response.headers['Vary'] = 'Accept-Encoding'
+            return response
+
+        return self.response_class(join_fragment(head, fragment), mimetype='application/json')
+
+    def stream(self):
+        args = get_args()
+        if args.no_stream:
+            abort(404)
 
-        if request.args.get('status', 'false') == 'true':
-            args = get_args()
-            d = {}
-            if args.status_page_password is None:
-                d['error'] = 'Access denied'
-            elif request.args.get('password', None) == args.status_page_password:
-                d['main_workers'] = MainWorker.get_all()
-                d['workers'] = WorkerStatus.get_all()
-        return jsonify(d)
+        bounds = [request.args.get(k, type=float) for k in ('swLat', 'swLng', 'neLat', 'neLng')]
+        if None in bounds:
+            abort(400)
+
+        layers = []
+        if request.args.get('pokemon', 'true') == 'true':
+            layers.extend(['pokemon', 'expired'])
+        if request.args.get('pokestops', 'true') == 'true':
+            layers.append('pokestops')
+        if request.args.get('gyms', 'true') == 'true':
+            layers.append('gyms')
+        if request.args.get('scanned', 'true') == 'true':
+            layers.append('scanned')
+
+        sub = stream_broker.subscribe(*(bounds + [layers]))
+
+        def events():
+            try:
+                yield 'retry: 5000\n\n'
+                while not sub.closed:
+                    # An open stream keeps on-demand scanning alive, like polling did.
+                    self.heartbeat[0] = now()
+                    if args.on_demand_timeout > 0:
+                        self.search_control.clear()
+                    try:
+                        event = sub.queue.get(timeout=15)
+                    except Empty:
+                        yield ': ping\n\n'
+                        continue
+                    if event is None:
+                        break
+                    yield event
+            finally:
+                stream_broker.unsubscribe(sub)
+
+        return Response(events(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache',
+                                 'X-Accel-Buffering': 'no'})
 
     def loc(self):
         d = {}
@@ -284,24 +437,20 @@ class Pogom(Flask):
         # Allow client to specify location.
         lat = request.args.get('lat', self.current_location[0], type=float)
         lon = request.args.get('lon', self.current_location[1], type=float)
-        origin_point = LatLng.from_degrees(lat, lon)
-
-        for pokemon in Pokemon.get_active(None, None, None, None):
-            pokemon_point = LatLng.from_degrees(pokemon['latitude'],
-                                                pokemon['longitude'])
-            diff = pokemon_point - origin_point
-            diff_lat = diff.lat().degrees
-            diff_lng = diff.lng().degrees
+
+        args = get_args()
+        for distance, pokemon in Pokemon.get_nearest(lat, lon, args.mobile_radius, args.mobile_limit):
+            diff_lat = pokemon['latitude'] - lat
+            diff_lng = pokemon['longitude'] - lon
             direction = (('N' if diff_lat >= 0 else 'S')
                          if abs(diff_lat) > 1e-4 else '') +\
                         (('E' if diff_lng >= 0 else 'W')
                          if abs(diff_lng) > 1e-4 else '')
             entry = {
                 'id': pokemon['pokemon_id'],
-                'name': pokemon['pokemon_name'],
+                'name': get_pokemon_name(pokemon['pokemon_id']),
                 'card_dir': direction,
-                'distance': int(origin_point.get_distance(
-                    pokemon_point).radians * 6366468.241830914),
+                'distance': int(distance),
                 'time_to_disappear': '%d min %d sec' % (divmod((
                     pokemon['disappear_time'] - datetime.utcnow()).seconds, 60)),
                 'disappear_time': pokemon['disappear_time'],
@@ -309,8 +458,7 @@ class Pogom(Flask):
                 'latitude': pokemon['latitude'],
                 'longitude': pokemon['longitude']
             }
-            pokemon_list.append((entry, entry['distance']))
-        pokemon_list = [y[0] for y in sorted(pokemon_list, key=lambda x: x[1])]
+            pokemon_list.append(entry)
         return render_template('mobile_list.html',
                                pokemon_list=pokemon_list,
                                origin_lat=lat,
@@ -0,0 +1,193 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import math
+import struct
+import threading
+import time
+import zlib
+
+from cachetools import TTLCache
+
+GZIP_HEADER = '\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+
+
+def deflate_block(data, final=False):
+    # Raw deflate, fully flushed, so blocks from different compressors
+    # can be concatenated into a single stream.
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if final else zlib.Z_FULL_FLUSH)
+
+
+# Tracks the last time rows were committed in each tile of a coarse grid, so
+# cached responses covering those tiles can be thrown away. Tiles not bumped
+# for prune_after seconds are forgotten, they then count as changed at the
+# version they were dropped at, which only costs entries that old a miss.
+class TileVersions(object):
+
+    def __init__(self, tile_size=0.01, max_tiles=2500, prune_after=60):
+        self.tile_size = tile_size
+        # Viewports spanning more tiles than this are checked against the
+        # global version instead of tile by tile.
+        self.max_tiles = max_tiles
+        self.prune_after = prune_after
+        self.versions = {}
+        self.version = 0
+        self.floor = 0  # version of the tiles dropped by the last prune
+        self.mark = 0  # version at the last prune
+        self.pruned_at = time.time()
+        self.lock = threading.Lock()
+
+    def _tile(self, latitude, longitude):
+        return (int(math.floor(latitude / self.tile_size)),
+                int(math.floor(longitude / self.tile_size)))
+
+    # Grow a box outwards to the tile grid.
+    def snap(self, swLat, swLng, neLat, neLng):
+        size = self.tile_size
+        return (round(math.floor(float(swLat) / size) * size, 6),
+                round(math.floor(float(swLng) / size) * size, 6),
+                round(math.ceil(float(neLat) / size) * size, 6),
+                round(math.ceil(float(neLng) / size) * size, 6))
+
+    def bump(self, rows):
+        with self.lock:
+            self.version += 1
+            for row in rows:
+                self.versions[self._tile(row['latitude'], row['longitude'])] = self.version
+
+            now = time.time()
+            if now - self.pruned_at > self.prune_after:
+                # Drop the tiles not bumped since the previous prune.
+                self.versions = dict((tile, version) for tile, version in self.versions.iteritems()
+                                     if version > self.mark)
+                self.floor = self.mark
+                self.mark = self.version
+                self.pruned_at = now
+
+    # Whether rows were committed in the box after the given version.
+    def changed_since(self, bounds, version):
+        sw = self._tile(*bounds[:2])
+        ne = self._tile(*bounds[2:])
+        if (ne[0] - sw[0] + 1) * (ne[1] - sw[1] + 1) > self.max_tiles:
+            return self.version > version
+
+        with self.lock:
+            versions, floor = self.versions, self.floor
+
+        for x in xrange(sw[0], ne[0] + 1):
+            for y in xrange(sw[1], ne[1] + 1):
+                if versions.get((x, y), floor) > version:
+                    return True
+
+        return False
+
+
+# Short lived cache of serialized /raw_data payloads, shared by every client
+# looking at the same tiles. Entries keep both the JSON fragment and its
+# deflated form, so hits cost neither a query nor a serialization.
+class ResponseCache(object):
+
+    def __init__(self, ttl=5, maxsize=512, tile_size=0.01):
+        self.maxsize = maxsize
+        self.tiles = TileVersions(tile_size)
+        self.lock = threading.Lock()
+        self.set_ttl(ttl)
+
+    def set_ttl(self, ttl):
+        with self.lock:
+            self.ttl = ttl
+            self.entries = TTLCache(maxsize=self.maxsize, ttl=max(ttl, 1))
+
+    def snap(self, swLat, swLng, neLat, neLng):
+        return self.tiles.snap(swLat, swLng, neLat, neLng)
+
+    # Round a client timestamp (ms) down, so polls made around the same time
+    # share an entry. Returning rows modified a bit earlier is harmless.
+    def bucket(self, timestamp):
+        step = self.ttl * 1000
+        return timestamp - timestamp % step
+
+    def version(self):
+        return self.tiles.version
+
+    def invalidate(self, rows):
+        rows = [r for r in rows if r.get('latitude') is not None]
+        if rows:
+            self.tiles.bump(rows)
+
+    # Returns (computed_at, fragment, deflated), or None if nothing usable is
+    # cached for the key.
+    def get(self, key, bounds):
+        with self.lock:
+            entry = self.entries.get(key)
+
+        if entry is None or self.tiles.changed_since(bounds, entry[0]):
+            return None
+
+        return entry[1:]
+
+    # The version must be read before running the queries, so rows committed
+    # while they run invalidate the entry.
+    def put(self, key, version, computed_at, fragment):
+        entry = (version, computed_at, fragment, deflate_block(fragment))
+        with self.lock:
+            self.entries[key] = entry
+        return entry[1:]
+
+
+# Wrap per request JSON around a cached fragment, as '{<head>,<fragment>}'.
+def join_fragment(head, fragment):
+    if not fragment:
+        return head
+    if head == '{}':
+        return '{' + fragment + '}'
+    return head[:-1] + ',' + fragment + '}'
+
+
+# Same as join_fragment, but produces a gzip body reusing the already
+# deflated fragment instead of compressing it again.
+def gzip_fragment(head, fragment, deflated):
+    if not fragment:
+        prefix, fragment, deflated, suffix = head, '', '', ''
+    elif head == '{}':
+        prefix, suffix = '{', '}'
+    else:
+        prefix, suffix = head[:-1] + ',', '}'
+
+    crc = zlib.crc32(prefix)
+    crc = zlib.crc32(fragment, crc)
+    crc = zlib.crc32(suffix, crc)
+    size = len(prefix) + len(fragment) + len(suffix)
+
+    return ''.join([GZIP_HEADER,
+                    deflate_block(prefix),
+                    deflated,
+                    deflate_block(suffix, final=True),
+                    struct.pack('<II', crc & 0xffffffff, size & 0xffffffff)])
+
+
+# Denormalized gym names and members, so map polls don't have to join the
+# member, pokemon and trainer tables. Entries are keyed on the
+# GymDetails.last_scanned they were built from; a newer details scan, from
+# this or another instance, makes them stale.
+class GymRosterCache(object):
+
+    def __init__(self):
+        self.rosters = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.rosters)
+
+    def get(self, gym_id, last_scanned):
+        roster = self.rosters.get(gym_id)
+        if roster is None or roster['last_scanned'] < last_scanned:
+            return None
+        return roster
+
+    def set(self, gym_id, roster):
+        with self.lock:
+            current = self.rosters.get(gym_id)
+            if current is None or current['last_scanned'] <= roster['last_scanned']:
+                self.rosters[gym_id] = roster
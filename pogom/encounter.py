@@ -0,0 +1,119 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import heapq
+import itertools
+import threading
+import time
+import weakref
+
+
+# Encounters queued by parse_map, to be made by the encounter workers instead
+# of the search worker that found the Pokemon. Jobs are handed out soonest
+# despawning first. Requests go through the api of the account that saw the
+# Pokemon, one at a time: the search worker holds lock(api) for its own
+# requests, and encounters of an account are spaced by delay seconds.
+#
+# Encounters are made from where the account saw the Pokemon. Before moving
+# on, the search worker waits for its account's encounters, and the ones
+# still queued after that are dropped, as are the ones of retired accounts.
+class EncounterQueue(object):
+
+    RETIRED = -1
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.jobs = []
+        self.counter = itertools.count()
+        lock = threading.Lock()
+        self.ready = threading.Condition(lock)  # jobs were queued
+        self.idle = threading.Condition(lock)  # an account's jobs are done
+        self.guard = threading.Lock()
+        self.locks = weakref.WeakKeyDictionary()
+        self.next_time = weakref.WeakKeyDictionary()
+        self.pending = weakref.WeakKeyDictionary()  # api -> jobs not done yet
+        self.epochs = weakref.WeakKeyDictionary()  # api -> moves, or RETIRED
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def lock(self, api):
+        with self.guard:
+            lock = self.locks.get(api)
+            if lock is None:
+                lock = self.locks[api] = threading.RLock()
+            return lock
+
+    # Book the next encounter slot of the account, returning the seconds to
+    # wait for it.
+    def reserve(self, api):
+        with self.guard:
+            now = time.time()
+            start = max(now, self.next_time.get(api, 0))
+            self.next_time[api] = start + self.delay
+            return start - now
+
+    # Queue an encounter of the wild Pokemon p, seen through api at position.
+    # pokemon is its row as already published, webhook the extra fields of
+    # its webhook message, if webhooks are on.
+    def put(self, api, position, p, pokemon, webhook):
+        job = {
+            'api': api,
+            'position': position,
+            'encounter_id': p['encounter_id'],
+            'spawn_point_id': p['spawn_point_id'],
+            'pokemon': pokemon,
+            'webhook': webhook,
+        }
+        with self.ready:
+            job['epoch'] = self.epochs.get(api, 0)
+            if job['epoch'] == self.RETIRED:
+                return
+            self.pending[api] = self.pending.get(api, 0) + 1
+            heapq.heappush(self.jobs, (pokemon['disappear_time'], next(self.counter), job))
+            self.ready.notify()
+
+    # Returns the next job still current. Call done(job) once it is handled.
+    def get(self):
+        with self.ready:
+            while True:
+                while not self.jobs:
+                    self.ready.wait()
+                job = heapq.heappop(self.jobs)[2]
+                if self.epochs.get(job['api'], 0) == job['epoch']:
+                    return job
+                self._done(job)
+
+    def done(self, job):
+        with self.ready:
+            self._done(job)
+
+    def _done(self, job):
+        pending = self.pending[job['api']] - 1
+        self.pending[job['api']] = pending
+        if not pending:
+            self.idle.notify_all()
+
+    # Whether the account is still where it was when job was queued. Check it
+    # holding lock(api), before making the encounter.
+    def current(self, job):
+        with self.ready:
+            return self.epochs.get(job['api'], 0) == job['epoch']
+
+    # Wait up to timeout seconds for the account's queued encounters, then
+    # drop the ones left, before the search worker moves the account.
+    def wait(self, api, timeout):
+        deadline = time.time() + timeout
+        with self.idle:
+            while self.pending.get(api, 0):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.idle.wait(remaining)
+            if self.epochs.get(api, 0) != self.RETIRED:
+                self.epochs[api] = self.epochs.get(api, 0) + 1
+
+    # Drop the encounters of an account the search worker stopped using.
+    def retire(self, api):
+        with self.ready:
+            self.epochs[api] = self.RETIRED
@@ -0,0 +1,78 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import zlib
+
+from .utils import get_species
+
+
+# Serializes map layers straight from query results into JSON chunks, so
+# large responses never exist as one list of dicts or one big string. Rows
+# are encoded as they come; the static per species fields are spliced in
+# from the fragments of the species table.
+class JSONStreamer(object):
+
+    def __init__(self, json_encoder, batch_size=200):
+        self.encoder = json_encoder(separators=(',', ':'))
+        self.batch_size = batch_size
+
+    def encode_row(self, row, species=False):
+        encoded = self.encoder.encode(row)
+        if species and 'pokemon_name' not in row:
+            encoded = encoded[:-1] + ',' + get_species(row['pokemon_id']).fragment + '}'
+        return encoded
+
+    # Yield '[row,row,...]' in batches of rows, or '{"key":row,...}' for rows
+    # given as {key: row}, like the gyms.
+    def iterencode_rows(self, rows, species=False):
+        if isinstance(rows, dict):
+            opening, closing = '{', '}'
+            items = ((self.encoder.encode(key) + ':', row) for key, row in rows.iteritems())
+        else:
+            opening, closing = '[', ']'
+            items = (('', row) for row in rows)
+
+        yield opening
+        batch = []
+        first = True
+        for key, row in items:
+            batch.append(key + self.encode_row(row, species))
+            if len(batch) >= self.batch_size:
+                yield ('' if first else ',') + ','.join(batch)
+                first = False
+                batch = []
+        if batch:
+            yield ('' if first else ',') + ','.join(batch)
+        yield closing
+
+    # Yield the members of an object, without the braces, for layers given as
+    # {key: rows}. Rows of the keys in species get the species fields.
+    def iterencode_layers(self, layers, species=('pokemons',)):
+        first = True
+        for key, rows in layers.iteritems():
+            yield ('' if first else ',') + self.encoder.encode(key) + ':'
+            first = False
+            for chunk in self.iterencode_rows(rows, key in species):
+                yield chunk
+
+    # Yield a whole object, with the small fields of head encoded as usual.
+    def iterencode(self, head, layers):
+        head = self.encoder.encode(head)
+        if not layers:
+            yield head
+            return
+
+        yield head[:-1] + (',' if head != '{}' else '')
+        for chunk in self.iterencode_layers(layers):
+            yield chunk
+        yield '}'
+
+
+# Gzip a stream of chunks as they are produced.
+def gzip_stream(chunks, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
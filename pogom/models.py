@@ -10,55 +10,149 @@ import gc
 import time
 import geopy
 import math
+import threading
+import sqlite3
 from peewee import SqliteDatabase, InsertQuery, \
     Check, CompositeKey, \
     IntegerField, CharField, DoubleField, BooleanField, \
-    DateTimeField, fn, DeleteQuery, FloatField, SQL, TextField, JOIN
+    DateTimeField, fn, DeleteQuery, FloatField, TextField
 from playhouse.flask_utils import FlaskDB
 from playhouse.pool import PooledMySQLDatabase
 from playhouse.shortcuts import RetryOperationalError
 from playhouse.migrate import migrate, MySQLMigrator, SqliteMigrator
 from datetime import datetime, timedelta
 from base64 import b64encode
-from cachetools import TTLCache
-from cachetools import cached
+from collections import OrderedDict, deque
+from queue import Empty
 
 from . import config
-from .utils import get_pokemon_name, get_pokemon_rarity, get_pokemon_types, get_args, \
-    cellid, in_radius, date_secs, clock_between, secs_between, get_move_name, get_move_damage, \
-    get_move_energy, get_move_type
-from .transform import transform_from_wgs_to_gcj, get_new_coords
+from .utils import get_pokemon_name, get_species, get_move, get_args, \
+    cellid, in_radius, date_secs, clock_between, secs_between
+from .transform import transform_rows_from_wgs_to_gcj, get_new_coords
 from .customLog import printPokemon
+from .spatial import ActivePokemonIndex, FortPresenceIndex, box_around, nearest
+from .cache import ResponseCache, GymRosterCache
+from .stream import StreamBroker
+from .rollup import count_sightings, hour_bucket, day_bucket
+from .state import ScanStateStore
 log = logging.getLogger(__name__)
 
 args = get_args()
 flaskDb = FlaskDB()
-cache = TTLCache(maxsize=100, ttl=60 * 5)
+pokemon_index = ActivePokemonIndex()
+response_cache = ResponseCache()
+stream_broker = StreamBroker()
+gym_rosters = GymRosterCache()
+scan_state = ScanStateStore()
+fort_presence = FortPresenceIndex()
 
-db_schema_version = 11
+db_schema_version = 15
 
 
 class MyRetryDB(RetryOperationalError, PooledMySQLDatabase):
     pass
 
 
+# Connection role of the current thread. Web requests read, everything else
+# (parsing, upserts, cleanup, schedulers) writes.
+db_role = threading.local()
+
+
+def set_db_role(role):
+    db_role.role = role
+
+
+# The primary database, handing the queries of threads in the 'read' role to
+# a separate pool, on a replica if one is configured. Upserts and the
+# scanner's read-modify-write queries stay on the primary.
+class RoutedDB(MyRetryDB):
+
+    def __init__(self, *args, **kwargs):
+        self.replica = kwargs.pop('replica', None)
+        super(RoutedDB, self).__init__(*args, **kwargs)
+
+    def route(self):
+        if self.replica is not None and getattr(db_role, 'role', None) == 'read':
+            return self.replica
+        return None
+
+    def connect(self):
+        replica = self.route()
+        return replica.connect() if replica else super(RoutedDB, self).connect()
+
+    def close(self):
+        replica = self.route()
+        return replica.close() if replica else super(RoutedDB, self).close()
+
+    def is_closed(self):
+        replica = self.route()
+        return replica.is_closed() if replica else super(RoutedDB, self).is_closed()
+
+    def get_conn(self):
+        replica = self.route()
+        return replica.get_conn() if replica else super(RoutedDB, self).get_conn()
+
+    def execute_sql(self, sql, params=None, require_commit=True):
+        replica = self.route()
+        if replica:
+            return replica.execute_sql(sql, params, require_commit)
+        return super(RoutedDB, self).execute_sql(sql, params, require_commit)
+
+    def atomic(self):
+        replica = self.route()
+        return replica.atomic() if replica else super(RoutedDB, self).atomic()
+
+    def transaction(self):
+        replica = self.route()
+        return replica.transaction() if replica else super(RoutedDB, self).transaction()
+
+
 def init_database(app):
     if args.db_type == 'mysql':
         log.info('Connecting to MySQL database on %s:%i', args.db_host, args.db_port)
-        connections = args.db_max_connections
-        if hasattr(args, 'accounts'):
-            connections *= len(args.accounts)
-        db = MyRetryDB(
+        connections = args.db_write_connections
+        if not connections:
+            connections = args.db_max_connections
+            if hasattr(args, 'accounts'):
+                connections *= len(args.accounts)
+
+        replica = None
+        if args.db_read_host and not args.db_read_connections:
+            log.warning('--db-read-host needs --db-read-connections, reading from the primary.')
+        if args.db_read_connections > 0:
+            read_host = args.db_read_host or args.db_host
+            read_port = args.db_read_port or args.db_port
+            log.info('Serving web reads from MySQL on %s:%i with up to %i connections',
+                     read_host, read_port, args.db_read_connections)
+            replica = MyRetryDB(
+                args.db_name,
+                user=args.db_user,
+                password=args.db_pass,
+                host=read_host,
+                port=read_port,
+                max_connections=args.db_read_connections,
+                stale_timeout=300)
+
+        db = RoutedDB(
             args.db_name,
             user=args.db_user,
             password=args.db_pass,
             host=args.db_host,
             port=args.db_port,
             max_connections=connections,
-            stale_timeout=300)
+            stale_timeout=300,
+            replica=replica)
     else:
         log.info('Connecting to local SQLite database')
-        db = SqliteDatabase(args.db)
+        # WAL lets the web server read while the db updater commits, and
+        # writers wait on each other's locks instead of failing.
+        db = SqliteDatabase(args.db, pragmas=[
+            ('journal_mode', 'wal'),
+            ('synchronous', 'normal'),
+            ('cache_size', -16000),
+            ('mmap_size', 256 * 1024 * 1024),
+            ('busy_timeout', 10000)
+        ], timeout=10)
 
     app.config['DATABASE'] = db
     flaskDb.init_app(app)
@@ -72,10 +166,7 @@ class BaseModel(flaskDb.Model):
     def get_all(cls):
         results = [m for m in cls.select().dicts()]
         if args.china:
-            for result in results:
-                result['latitude'], result['longitude'] = \
-                    transform_from_wgs_to_gcj(
-                        result['latitude'], result['longitude'])
+            results = list(transform_rows_from_wgs_to_gcj(results))
         return results
 
 
@@ -96,21 +187,49 @@ class Pokemon(BaseModel):
     last_modified = DateTimeField(null=True, index=True, default=datetime.utcnow)
 
     class Meta:
-        indexes = ((('latitude', 'longitude'), False),)
+        indexes = ((('latitude', 'longitude', 'disappear_time'), False),)
+        # A scan whose encounter failed doesn't wipe the stats of an earlier one.
+        upsert_coalesce = ('individual_attack', 'individual_defense',
+                           'individual_stamina', 'move_1', 'move_2')
 
+    # Yields active Pokemon rows one by one, without the species fields, for
+    # callers that serialize them as they go.
     @staticmethod
-    def get_active(swLat, swLng, neLat, neLng, timestamp=0, oSwLat=None, oSwLng=None, oNeLat=None, oNeLng=None):
+    def iter_active(swLat, swLng, neLat, neLng, timestamp=0, oSwLat=None, oSwLng=None, oNeLat=None, oNeLng=None):
         now_date = datetime.utcnow()
         # now_secs = date_secs(now_date)
         query = Pokemon.select()
-        if not (swLat and swLng and neLat and neLng):
+        if pokemon_index.ready:
+            # Answer from memory, the index holds every Pokemon that hasn't despawned yet.
+            if not (swLat and swLng and neLat and neLng):
+                query = pokemon_index.find()
+            elif timestamp > 0 and oSwLat and oSwLng and oNeLat and oNeLng:
+                query = pokemon_index.find(swLat, swLng, neLat, neLng,
+                                           since=datetime.utcfromtimestamp(timestamp / 1000),
+                                           exclude=(oSwLat, oSwLng, oNeLat, oNeLng))
+            elif timestamp > 0:
+                query = pokemon_index.find(swLat, swLng, neLat, neLng,
+                                           since=datetime.utcfromtimestamp(timestamp / 1000))
+            elif oSwLat and oSwLng and oNeLat and oNeLng:
+                query = pokemon_index.find(swLat, swLng, neLat, neLng,
+                                           exclude=(oSwLat, oSwLng, oNeLat, oNeLng))
+            else:
+                query = pokemon_index.find(swLat, swLng, neLat, neLng)
+        elif not (swLat and swLng and neLat and neLng):
             query = (query
                      .where(Pokemon.disappear_time > now_date)
                      .dicts())
         elif timestamp > 0:
             # If timestamp is known only load modified pokemon.
+            changed = (Pokemon.last_modified > datetime.utcfromtimestamp(timestamp / 1000))
+            if oSwLat and oSwLng and oNeLat and oNeLng:
+                # Plus the newly uncovered ones, in the same pass.
+                changed = changed | ~((Pokemon.latitude >= oSwLat) &
+                                      (Pokemon.longitude >= oSwLng) &
+                                      (Pokemon.latitude <= oNeLat) &
+                                      (Pokemon.longitude <= oNeLng))
             query = (query
-                     .where(((Pokemon.last_modified > datetime.utcfromtimestamp(timestamp / 1000)) &
+                     .where((changed &
                              (Pokemon.disappear_time > now_date)) &
                             ((Pokemon.latitude >= swLat) &
                              (Pokemon.longitude >= swLng) &
@@ -142,18 +261,27 @@ class Pokemon(BaseModel):
                               (Pokemon.longitude <= neLng))))
                      .dicts())
 
+        if not pokemon_index.ready:
+            # Don't keep every row around in the query's result cache.
+            query = query.iterator()
+
+        if args.china:
+            query = transform_rows_from_wgs_to_gcj(query)
+
+        for p in query:
+            yield p
+
+    @staticmethod
+    def get_active(swLat, swLng, neLat, neLng, timestamp=0, oSwLat=None, oSwLng=None, oNeLat=None, oNeLng=None):
         # Performance: Disable the garbage collector prior to creating a (potentially) large dict with append().
         gc.disable()
 
         pokemons = []
-        for p in list(query):
-
-            p['pokemon_name'] = get_pokemon_name(p['pokemon_id'])
-            p['pokemon_rarity'] = get_pokemon_rarity(p['pokemon_id'])
-            p['pokemon_types'] = get_pokemon_types(p['pokemon_id'])
-            if args.china:
-                p['latitude'], p['longitude'] = \
-                    transform_from_wgs_to_gcj(p['latitude'], p['longitude'])
+        for p in Pokemon.iter_active(swLat, swLng, neLat, neLng, timestamp, oSwLat, oSwLng, oNeLat, oNeLng):
+            species = get_species(p['pokemon_id'])
+            p['pokemon_name'] = species.name
+            p['pokemon_rarity'] = species.rarity
+            p['pokemon_types'] = species.types
             pokemons.append(p)
 
         # Re-enable the GC.
@@ -161,9 +289,46 @@ class Pokemon(BaseModel):
 
         return pokemons
 
+    # The active Pokemon closest to a point, as (meters, row) nearest first.
+    # With --china the point is in GCJ-02 while the rows are WGS-84, up to a
+    # few hundred meters off, so the box is widened and the rows are moved
+    # before they are ranked.
+    @staticmethod
+    def get_nearest(latitude, longitude, radius=0, limit=0):
+        if radius:
+            margin = 1000 if args.china else 0
+            swLat, swLng, neLat, neLng = box_around(latitude, longitude, radius + margin)
+
+        if pokemon_index.ready:
+            if radius:
+                pokemons = pokemon_index.find(swLat, swLng, neLat, neLng)
+            else:
+                pokemons = pokemon_index.find()
+        else:
+            query = (Pokemon
+                     .select()
+                     .where(Pokemon.disappear_time > datetime.utcnow()))
+            if radius:
+                query = query.where((Pokemon.latitude >= swLat) &
+                                    (Pokemon.longitude >= swLng) &
+                                    (Pokemon.latitude <= neLat) &
+                                    (Pokemon.longitude <= neLng))
+            pokemons = list(query.dicts())
+
+        if args.china:
+            # Copies, the index records are shared.
+            pokemons = list(transform_rows_from_wgs_to_gcj([dict(p) for p in pokemons]))
+
+        return nearest(pokemons, latitude, longitude, radius, limit)
+
     @staticmethod
     def get_active_by_id(ids, swLat, swLng, neLat, neLng):
-        if not (swLat and swLng and neLat and neLng):
+        if pokemon_index.ready:
+            if not (swLat and swLng and neLat and neLng):
+                query = pokemon_index.find(pokemon_ids=ids)
+            else:
+                query = pokemon_index.find(swLat, swLng, neLat, neLng, pokemon_ids=ids)
+        elif not (swLat and swLng and neLat and neLng):
             query = (Pokemon
                      .select()
                      .where((Pokemon.pokemon_id << ids) &
@@ -185,58 +350,117 @@ class Pokemon(BaseModel):
 
         pokemons = []
         for p in query:
-            p['pokemon_name'] = get_pokemon_name(p['pokemon_id'])
-            p['pokemon_rarity'] = get_pokemon_rarity(p['pokemon_id'])
-            p['pokemon_types'] = get_pokemon_types(p['pokemon_id'])
-            if args.china:
-                p['latitude'], p['longitude'] = \
-                    transform_from_wgs_to_gcj(p['latitude'], p['longitude'])
+            species = get_species(p['pokemon_id'])
+            p['pokemon_name'] = species.name
+            p['pokemon_rarity'] = species.rarity
+            p['pokemon_types'] = species.types
             pokemons.append(p)
 
         # Re-enable the GC.
         gc.enable()
 
+        if args.china:
+            pokemons = list(transform_rows_from_wgs_to_gcj(pokemons))
+
         return pokemons
 
     @classmethod
-    @cached(cache)
     def get_seen(cls, timediff):
+        # Answered from the rollup tables, which hold the sightings up to the
+        # watermark of seen_stats_loop. The partial hour the window starts in
+        # and the sightings after the watermark are counted from the pokemon
+        # table.
+        watermark = datetime.utcfromtimestamp(get_seen_watermark())
+        recent = Pokemon.disappear_time > watermark
+        counts = {}
         if timediff:
-            timediff = datetime.utcnow() - timediff
-        pokemon_count_query = (Pokemon
-                               .select(Pokemon.pokemon_id,
-                                       fn.COUNT(Pokemon.pokemon_id).alias('count'),
-                                       fn.MAX(Pokemon.disappear_time).alias('lastappeared')
-                                       )
-                               .where(Pokemon.disappear_time > timediff)
-                               .group_by(Pokemon.pokemon_id)
-                               .alias('counttable')
-                               )
-        query = (Pokemon
-                 .select(Pokemon.pokemon_id,
-                         Pokemon.disappear_time,
-                         Pokemon.latitude,
-                         Pokemon.longitude,
-                         pokemon_count_query.c.count)
-                 .join(pokemon_count_query, on=(Pokemon.pokemon_id == pokemon_count_query.c.pokemon_id))
-                 .distinct()
-                 .where(Pokemon.disappear_time == pokemon_count_query.c.lastappeared)
-                 .dicts()
-                 )
+            start = datetime.utcnow() - timediff
+            hour = hour_bucket(start) + timedelta(hours=1)
+            day = day_bucket(hour)
+            if day < hour:
+                day += timedelta(days=1)
+
+            partial = (Pokemon
+                       .select(Pokemon.pokemon_id,
+                               fn.COUNT(Pokemon.pokemon_id).alias('count'))
+                       .where((Pokemon.disappear_time > start) &
+                              (Pokemon.disappear_time < hour) &
+                              (Pokemon.disappear_time <= watermark))
+                       .group_by(Pokemon.pokemon_id)
+                       .dicts())
+            for p in partial:
+                counts[p['pokemon_id']] = int(p['count'])
+
+            hourly = (PokemonSeenHourly
+                      .select(PokemonSeenHourly.pokemon_id,
+                              fn.SUM(PokemonSeenHourly.count).alias('count'))
+                      .where((PokemonSeenHourly.hour >= hour) &
+                             (PokemonSeenHourly.hour < day))
+                      .group_by(PokemonSeenHourly.pokemon_id)
+                      .dicts())
+            for p in hourly:
+                counts[p['pokemon_id']] = counts.get(p['pokemon_id'], 0) + int(p['count'])
+
+            recent &= Pokemon.disappear_time > start
+        else:
+            day = None
 
-        # Performance: Disable the garbage collector prior to creating a (potentially) large dict with append().
-        gc.disable()
+        daily = (PokemonSeenDaily
+                 .select(PokemonSeenDaily.pokemon_id,
+                         fn.SUM(PokemonSeenDaily.count).alias('count'))
+                 .group_by(PokemonSeenDaily.pokemon_id)
+                 .dicts())
+        if day:
+            daily = daily.where(PokemonSeenDaily.day >= day)
+        for p in daily:
+            counts[p['pokemon_id']] = counts.get(p['pokemon_id'], 0) + int(p['count'])
+
+        tail = (Pokemon
+                .select(Pokemon.pokemon_id,
+                        fn.COUNT(Pokemon.pokemon_id).alias('count'))
+                .where(recent)
+                .group_by(Pokemon.pokemon_id)
+                .dicts())
+        for p in tail:
+            counts[p['pokemon_id']] = counts.get(p['pokemon_id'], 0) + int(p['count'])
+
+        last_seen = {}
+        if counts:
+            query = (PokemonLastSeen
+                     .select()
+                     .where(PokemonLastSeen.pokemon_id << counts.keys())
+                     .dicts())
+            for p in query:
+                last_seen[p['pokemon_id']] = p
+
+            # The latest sightings after the watermark aren't in the rollup yet.
+            latest = (Pokemon
+                      .select(Pokemon.pokemon_id,
+                              fn.MAX(Pokemon.disappear_time).alias('lastappeared'))
+                      .where(recent)
+                      .group_by(Pokemon.pokemon_id)
+                      .alias('latest'))
+            query = (Pokemon
+                     .select(Pokemon.pokemon_id,
+                             Pokemon.disappear_time,
+                             Pokemon.latitude,
+                             Pokemon.longitude)
+                     .join(latest, on=(Pokemon.pokemon_id == latest.c.pokemon_id))
+                     .where(Pokemon.disappear_time == latest.c.lastappeared)
+                     .dicts())
+            for p in query:
+                last = last_seen.get(p['pokemon_id'])
+                if last is None or last['disappear_time'] < p['disappear_time']:
+                    last_seen[p['pokemon_id']] = p
 
         pokemons = []
         total = 0
-        for p in query:
+        for p in last_seen.values():
+            p['count'] = counts[p['pokemon_id']]
             p['pokemon_name'] = get_pokemon_name(p['pokemon_id'])
             pokemons.append(p)
             total += p['count']
 
-        # Re-enable the GC.
-        gc.enable()
-
         return {'pokemon': pokemons, 'total': total}
 
     @classmethod
@@ -246,18 +470,50 @@ class Pokemon(BaseModel):
         :param timediff: limiting period of the selection
         :return: list of  pokemon  appearances over a selected period
         '''
+        # The whole days up to the seen statistics watermark are counted in
+        # the appearance rollup. The partial day the window starts in and the
+        # sightings after the watermark are counted from the pokemon table.
+        watermark = datetime.utcfromtimestamp(get_seen_watermark())
+        rollup = PokemonAppearance.pokemon_id == pokemon_id
+        recent = Pokemon.disappear_time > watermark
         if timediff:
-            timediff = datetime.utcnow() - timediff
-        query = (Pokemon
-                 .select(Pokemon.latitude, Pokemon.longitude, Pokemon.pokemon_id, fn.Count(Pokemon.spawnpoint_id).alias('count'), Pokemon.spawnpoint_id)
-                 .where((Pokemon.pokemon_id == pokemon_id) &
-                        (Pokemon.disappear_time > timediff)
-                        )
-                 .group_by(Pokemon.latitude, Pokemon.longitude, Pokemon.pokemon_id, Pokemon.spawnpoint_id)
-                 .dicts()
-                 )
+            start = datetime.utcnow() - timediff
+            day = day_bucket(start)
+            if day < start:
+                day += timedelta(days=1)
+            rollup &= PokemonAppearance.day >= day
+            recent = (Pokemon.disappear_time > start) & ((Pokemon.disappear_time < day) | recent)
+
+        rolled_up = (PokemonAppearance
+                     .select(PokemonAppearance.pokemon_id,
+                             PokemonAppearance.spawnpoint_id,
+                             PokemonAppearance.latitude,
+                             PokemonAppearance.longitude,
+                             fn.SUM(PokemonAppearance.count).alias('count'))
+                     .where(rollup)
+                     .group_by(PokemonAppearance.pokemon_id, PokemonAppearance.spawnpoint_id,
+                               PokemonAppearance.latitude, PokemonAppearance.longitude)
+                     .dicts())
+        sightings = (Pokemon
+                     .select(Pokemon.pokemon_id,
+                             Pokemon.spawnpoint_id,
+                             Pokemon.latitude,
+                             Pokemon.longitude,
+                             fn.COUNT(Pokemon.pokemon_id).alias('count'))
+                     .where((Pokemon.pokemon_id == pokemon_id) & recent)
+                     .group_by(Pokemon.pokemon_id, Pokemon.spawnpoint_id, Pokemon.latitude, Pokemon.longitude)
+                     .dicts())
 
-        return list(query)
+        spawnpoints = {}
+        for row in itertools.chain(rolled_up, sightings):
+            row['count'] = int(row['count'])
+            key = (row['spawnpoint_id'], row['latitude'], row['longitude'])
+            if key in spawnpoints:
+                spawnpoints[key]['count'] += row['count']
+            else:
+                spawnpoints[key] = row
+
+        return spawnpoints.values()
 
     @classmethod
     def get_appearances_times_by_spawnpoint(cls, pokemon_id, spawnpoint_id, timediff):
@@ -267,125 +523,18 @@ class Pokemon(BaseModel):
         :param timediff: limiting period of the selection
         :return: list of time appearances over a selected period
         '''
-        if timediff:
-            timediff = datetime.utcnow() - timediff
+        # The appearance rollup only counts sightings per day, the times are
+        # read from the pokemon table, through its spawnpoint_id index.
         query = (Pokemon
                  .select(Pokemon.disappear_time)
                  .where((Pokemon.pokemon_id == pokemon_id) &
-                        (Pokemon.spawnpoint_id == spawnpoint_id) &
-                        (Pokemon.disappear_time > timediff)
-                        )
-                 .order_by(Pokemon.disappear_time.asc())
-                 .tuples()
-                 )
-
-        return list(itertools.chain(*query))
-
-    @classmethod
-    def get_spawn_time(cls, disappear_time):
-        return (disappear_time + 2700) % 3600
-
-    @classmethod
-    def get_spawnpoints(cls, swLat, swLng, neLat, neLng, timestamp=0, oSwLat=None, oSwLng=None, oNeLat=None, oNeLng=None):
-        query = Pokemon.select(Pokemon.latitude, Pokemon.longitude, Pokemon.spawnpoint_id, (date_secs(Pokemon.disappear_time)).alias('time'), fn.Count(Pokemon.spawnpoint_id).alias('count'))
-
-        if timestamp > 0:
-            query = (query
-                     .where(((Pokemon.last_modified > datetime.utcfromtimestamp(timestamp / 1000))) &
-                            ((Pokemon.latitude >= swLat) &
-                             (Pokemon.longitude >= swLng) &
-                             (Pokemon.latitude <= neLat) &
-                             (Pokemon.longitude <= neLng)))
-                     .dicts())
-        elif oSwLat and oSwLng and oNeLat and oNeLng:
-            # Send spawnpoints in view but exclude those within old boundaries. Only send newly uncovered spawnpoints.
-            query = (query
-                     .where((((Pokemon.latitude >= swLat) &
-                              (Pokemon.longitude >= swLng) &
-                              (Pokemon.latitude <= neLat) &
-                              (Pokemon.longitude <= neLng))) &
-                            ~((Pokemon.latitude >= oSwLat) &
-                              (Pokemon.longitude >= oSwLng) &
-                              (Pokemon.latitude <= oNeLat) &
-                              (Pokemon.longitude <= oNeLng)))
-                     .dicts())
-        elif swLat and swLng and neLat and neLng:
-            query = (query
-                     .where((Pokemon.latitude <= neLat) &
-                            (Pokemon.latitude >= swLat) &
-                            (Pokemon.longitude >= swLng) &
-                            (Pokemon.longitude <= neLng)
-                            ))
-
-        query = query.group_by(Pokemon.latitude, Pokemon.longitude, Pokemon.spawnpoint_id, SQL('time'))
-
-        queryDict = query.dicts()
-        spawnpoints = {}
-
-        for sp in queryDict:
-            key = sp['spawnpoint_id']
-            disappear_time = cls.get_spawn_time(sp.pop('time'))
-            count = int(sp['count'])
-
-            if key not in spawnpoints:
-                spawnpoints[key] = sp
-            else:
-                spawnpoints[key]['special'] = True
-
-            if 'time' not in spawnpoints[key] or count >= spawnpoints[key]['count']:
-                spawnpoints[key]['time'] = disappear_time
-                spawnpoints[key]['count'] = count
-
-        for sp in spawnpoints.values():
-            del sp['count']
-
-        return list(spawnpoints.values())
-
-    @classmethod
-    def get_spawnpoints_in_hex(cls, center, steps):
-        log.info('Finding spawn points {} steps away'.format(steps))
-
-        n, e, s, w = hex_bounds(center, steps)
-
-        query = (Pokemon
-                 .select(Pokemon.latitude.alias('lat'),
-                         Pokemon.longitude.alias('lng'),
-                         (date_secs(Pokemon.disappear_time)).alias('time'),
-                         Pokemon.spawnpoint_id
-                         ))
-        query = (query.where((Pokemon.latitude <= n) &
-                             (Pokemon.latitude >= s) &
-                             (Pokemon.longitude >= w) &
-                             (Pokemon.longitude <= e)
-                             ))
-        # Sqlite doesn't support distinct on columns.
-        if args.db_type == 'mysql':
-            query = query.distinct(Pokemon.spawnpoint_id)
-        else:
-            query = query.group_by(Pokemon.spawnpoint_id)
-
-        s = list(query.dicts())
-
-        # The distance between scan circles of radius 70 in a hex is 121.2436
-        # steps - 1 to account for the center circle then add 70 for the edge.
-        step_distance = ((steps - 1) * 121.2436) + 70
-        # Compare spawnpoint list to a circle with radius steps * 120.
-        # Uses the direct geopy distance between the center and the spawnpoint.
-        filtered = []
-
-        for idx, sp in enumerate(s):
-            if geopy.distance.distance(center, (sp['lat'], sp['lng'])).meters <= step_distance:
-                filtered.append(s[idx])
-
-        # At this point, 'time' is DISAPPEARANCE time, we're going to morph it to APPEARANCE time.
-        for location in filtered:
-            # examples: time    shifted
-            #           0       (   0 + 2700) = 2700 % 3600 = 2700 (0th minute to 45th minute, 15 minutes prior to appearance as time wraps around the hour.)
-            #           1800    (1800 + 2700) = 4500 % 3600 =  900 (30th minute, moved to arrive at 15th minute.)
-            # todo: this DOES NOT ACCOUNT for pokemons that appear sooner and live longer, but you'll _always_ have at least 15 minutes, so it works well enough.
-            location['time'] = cls.get_spawn_time(location['time'])
+                        (Pokemon.spawnpoint_id == spawnpoint_id))
+                 .order_by(Pokemon.disappear_time)
+                 .tuples())
+        if timediff:
+            query = query.where(Pokemon.disappear_time > datetime.utcnow() - timediff)
 
-        return filtered
+        return [t[0] for t in query]
 
 
 class Pokestop(BaseModel):
@@ -399,7 +548,7 @@ class Pokestop(BaseModel):
     last_updated = DateTimeField(null=True, index=True, default=datetime.utcnow)
 
     class Meta:
-        indexes = ((('latitude', 'longitude'), False),)
+        indexes = ((('latitude', 'longitude', 'last_updated'), False),)
 
     @staticmethod
     def get_stops(swLat, swLng, neLat, neLng, timestamp=0, oSwLat=None, oSwLng=None, oNeLat=None, oNeLng=None, lured=False):
@@ -410,8 +559,17 @@ class Pokestop(BaseModel):
             query = (query
                      .dicts())
         elif timestamp > 0:
+            changed = (Pokestop.last_updated > datetime.utcfromtimestamp(timestamp / 1000))
+            if oSwLat and oSwLng and oNeLat and oNeLng:
+                uncovered = ~((Pokestop.latitude >= oSwLat) &
+                              (Pokestop.longitude >= oSwLng) &
+                              (Pokestop.latitude <= oNeLat) &
+                              (Pokestop.longitude <= oNeLng))
+                if lured:
+                    uncovered = uncovered & (Pokestop.active_fort_modifier.is_null(False))
+                changed = changed | uncovered
             query = (query
-                     .where(((Pokestop.last_updated > datetime.utcfromtimestamp(timestamp / 1000))) &
+                     .where(changed &
                             (Pokestop.latitude >= swLat) &
                             (Pokestop.longitude >= swLng) &
                             (Pokestop.latitude <= neLat) &
@@ -465,14 +623,14 @@ class Pokestop(BaseModel):
 
         pokestops = []
         for p in query:
-            if args.china:
-                p['latitude'], p['longitude'] = \
-                    transform_from_wgs_to_gcj(p['latitude'], p['longitude'])
             pokestops.append(p)
 
         # Re-enable the GC.
         gc.enable()
 
+        if args.china:
+            pokestops = list(transform_rows_from_wgs_to_gcj(pokestops))
+
         return pokestops
 
 
@@ -493,7 +651,7 @@ class Gym(BaseModel):
     last_scanned = DateTimeField(default=datetime.utcnow)
 
     class Meta:
-        indexes = ((('latitude', 'longitude'), False),)
+        indexes = ((('latitude', 'longitude', 'last_scanned'), False),)
 
     @staticmethod
     def get_gyms(swLat, swLng, neLat, neLng, timestamp=0, oSwLat=None, oSwLng=None, oNeLat=None, oNeLng=None):
@@ -503,9 +661,15 @@ class Gym(BaseModel):
                        .dicts())
         elif timestamp > 0:
             # If timestamp is known only send last scanned Gyms.
+            changed = (Gym.last_scanned > datetime.utcfromtimestamp(timestamp / 1000))
+            if oSwLat and oSwLng and oNeLat and oNeLng:
+                changed = changed | ~((Gym.latitude >= oSwLat) &
+                                      (Gym.longitude >= oSwLng) &
+                                      (Gym.latitude <= oNeLat) &
+                                      (Gym.longitude <= oNeLng))
             results = (Gym
                        .select()
-                       .where(((Gym.last_scanned > datetime.utcfromtimestamp(timestamp / 1000)) &
+                       .where((changed &
                               (Gym.latitude >= swLat) &
                               (Gym.longitude >= swLng) &
                               (Gym.latitude <= neLat) &
@@ -546,34 +710,20 @@ class Gym(BaseModel):
             gym_ids.append(g['gym_id'])
 
         if len(gym_ids) > 0:
-            pokemon = (GymMember
-                       .select(
-                           GymMember.gym_id,
-                           GymPokemon.cp.alias('pokemon_cp'),
-                           GymPokemon.pokemon_id,
-                           Trainer.name.alias('trainer_name'),
-                           Trainer.level.alias('trainer_level'))
-                       .join(Gym, on=(GymMember.gym_id == Gym.gym_id))
-                       .join(GymPokemon, on=(GymMember.pokemon_uid == GymPokemon.pokemon_uid))
-                       .join(Trainer, on=(GymPokemon.trainer_name == Trainer.name))
-                       .where(GymMember.gym_id << gym_ids)
-                       .where(GymMember.last_scanned > Gym.last_modified)
-                       .order_by(GymMember.gym_id, GymPokemon.cp)
-                       .dicts())
-
-            for p in pokemon:
-                p['pokemon_name'] = get_pokemon_name(p['pokemon_id'])
-                gyms[p['gym_id']]['pokemon'].append(p)
-
-            details = (GymDetails
-                       .select(
-                           GymDetails.gym_id,
-                           GymDetails.name)
-                       .where(GymDetails.gym_id << gym_ids)
-                       .dicts())
-
-            for d in details:
-                gyms[d['gym_id']]['name'] = d['name']
+            for gym_id, roster in Gym.get_rosters(gym_ids).iteritems():
+                g = gyms[gym_id]
+                g['name'] = roster['name']
+                # Members are sorted by cp descending, the map wants ascending.
+                for m in reversed(roster['members']):
+                    if m['last_scanned'] > g['last_modified']:
+                        g['pokemon'].append({
+                            'gym_id': gym_id,
+                            'pokemon_cp': m['pokemon_cp'],
+                            'pokemon_id': m['pokemon_id'],
+                            'pokemon_name': m['pokemon_name'],
+                            'trainer_name': m['trainer_name'],
+                            'trainer_level': m['trainer_level'],
+                        })
 
         # Re-enable the GC.
         gc.enable()
@@ -585,58 +735,103 @@ class Gym(BaseModel):
         result = (Gym
                   .select(Gym.gym_id,
                           Gym.team_id,
-                          GymDetails.name,
-                          GymDetails.description,
                           Gym.guard_pokemon_id,
                           Gym.gym_points,
                           Gym.latitude,
                           Gym.longitude,
                           Gym.last_modified,
                           Gym.last_scanned)
-                  .join(GymDetails, JOIN.LEFT_OUTER, on=(Gym.gym_id == GymDetails.gym_id))
                   .where(Gym.gym_id == id)
                   .dicts()
                   .get())
 
         result['guard_pokemon_name'] = get_pokemon_name(result['guard_pokemon_id']) if result['guard_pokemon_id'] else ''
+        result['name'] = None
+        result['description'] = None
         result['pokemon'] = []
 
-        pokemon = (GymMember
-                   .select(GymPokemon.cp.alias('pokemon_cp'),
-                           GymPokemon.pokemon_id,
-                           GymPokemon.pokemon_uid,
-                           GymPokemon.move_1,
-                           GymPokemon.move_2,
-                           GymPokemon.iv_attack,
-                           GymPokemon.iv_defense,
-                           GymPokemon.iv_stamina,
-                           Trainer.name.alias('trainer_name'),
-                           Trainer.level.alias('trainer_level'))
-                   .join(Gym, on=(GymMember.gym_id == Gym.gym_id))
-                   .join(GymPokemon, on=(GymMember.pokemon_uid == GymPokemon.pokemon_uid))
-                   .join(Trainer, on=(GymPokemon.trainer_name == Trainer.name))
-                   .where(GymMember.gym_id == id)
-                   .where(GymMember.last_scanned > Gym.last_modified)
-                   .order_by(GymPokemon.cp.desc())
-                   .dicts())
+        roster = Gym.get_rosters([id]).get(id)
+        if roster is None:
+            return result
 
-        for p in pokemon:
-            p['pokemon_name'] = get_pokemon_name(p['pokemon_id'])
+        result['name'] = roster['name']
+        result['description'] = roster['description']
+
+        for m in roster['members']:
+            if m['last_scanned'] <= result['last_modified']:
+                continue
 
-            p['move_1_name'] = get_move_name(p['move_1'])
-            p['move_1_damage'] = get_move_damage(p['move_1'])
-            p['move_1_energy'] = get_move_energy(p['move_1'])
-            p['move_1_type'] = get_move_type(p['move_1'])
+            p = dict(m)
+            del p['last_scanned']
 
-            p['move_2_name'] = get_move_name(p['move_2'])
-            p['move_2_damage'] = get_move_damage(p['move_2'])
-            p['move_2_energy'] = get_move_energy(p['move_2'])
-            p['move_2_type'] = get_move_type(p['move_2'])
+            move = get_move(p['move_1'])
+            p['move_1_name'] = move.name
+            p['move_1_damage'] = move.damage
+            p['move_1_energy'] = move.energy
+            p['move_1_type'] = move.type
+
+            move = get_move(p['move_2'])
+            p['move_2_name'] = move.name
+            p['move_2_damage'] = move.damage
+            p['move_2_energy'] = move.energy
+            p['move_2_type'] = move.type
 
             result['pokemon'].append(p)
 
         return result
 
+    # Names and members of the given gyms, from the roster cache. Only gyms
+    # detail scanned since they were cached are loaded from the database.
+    @staticmethod
+    def get_rosters(gym_ids):
+        details = (GymDetails
+                   .select(GymDetails.gym_id,
+                           GymDetails.name,
+                           GymDetails.description,
+                           GymDetails.last_scanned)
+                   .where(GymDetails.gym_id << gym_ids)
+                   .dicts())
+
+        rosters = {}
+        stale = {}
+        for d in details:
+            roster = gym_rosters.get(d['gym_id'], d['last_scanned'])
+            if roster is None:
+                d['members'] = []
+                stale[d['gym_id']] = d
+            else:
+                rosters[d['gym_id']] = roster
+
+        if stale:
+            members = (GymMember
+                       .select(GymMember.gym_id,
+                               GymMember.last_scanned,
+                               GymPokemon.cp.alias('pokemon_cp'),
+                               GymPokemon.pokemon_id,
+                               GymPokemon.pokemon_uid,
+                               GymPokemon.move_1,
+                               GymPokemon.move_2,
+                               GymPokemon.iv_attack,
+                               GymPokemon.iv_defense,
+                               GymPokemon.iv_stamina,
+                               Trainer.name.alias('trainer_name'),
+                               Trainer.level.alias('trainer_level'))
+                       .join(GymPokemon, on=(GymMember.pokemon_uid == GymPokemon.pokemon_uid))
+                       .join(Trainer, on=(GymPokemon.trainer_name == Trainer.name))
+                       .where(GymMember.gym_id << stale.keys())
+                       .order_by(GymPokemon.cp.desc())
+                       .dicts())
+
+            for m in members:
+                m['pokemon_name'] = get_pokemon_name(m['pokemon_id'])
+                stale[m.pop('gym_id')]['members'].append(m)
+
+            for gym_id, roster in stale.iteritems():
+                gym_rosters.set(gym_id, roster)
+                rosters[gym_id] = roster
+
+        return rosters
+
 
 class ScannedLocation(BaseModel):
     cellid = CharField(primary_key=True, max_length=50)
@@ -667,7 +862,7 @@ class ScannedLocation(BaseModel):
     width = IntegerField(default=0)
 
     class Meta:
-        indexes = ((('latitude', 'longitude'), False),)
+        indexes = ((('latitude', 'longitude', 'last_modified'), False),)
         constraints = [Check('band1 >= -1'), Check('band1 < 3600'),
                        Check('band2 >= -1'), Check('band2 < 3600'),
                        Check('band3 >= -1'), Check('band3 < 3600'),
@@ -680,9 +875,16 @@ class ScannedLocation(BaseModel):
     def get_recent(swLat, swLng, neLat, neLng, timestamp=0, oSwLat=None, oSwLng=None, oNeLat=None, oNeLng=None):
         activeTime = (datetime.utcnow() - timedelta(minutes=15))
         if timestamp > 0:
+            changed = (ScannedLocation.last_modified >= datetime.utcfromtimestamp(timestamp / 1000))
+            if oSwLat and oSwLng and oNeLat and oNeLng:
+                changed = changed | ((ScannedLocation.last_modified >= activeTime) &
+                                     ~((ScannedLocation.latitude >= oSwLat) &
+                                       (ScannedLocation.longitude >= oSwLng) &
+                                       (ScannedLocation.latitude <= oNeLat) &
+                                       (ScannedLocation.longitude <= oNeLng)))
             query = (ScannedLocation
                      .select()
-                     .where(((ScannedLocation.last_modified >= datetime.utcfromtimestamp(timestamp / 1000))) &
+                     .where(changed &
                             (ScannedLocation.latitude >= swLat) &
                             (ScannedLocation.longitude >= swLng) &
                             (ScannedLocation.latitude <= neLat) &
@@ -747,13 +949,16 @@ class ScannedLocation(BaseModel):
     # return value of a particular scan from loc, or default dict if not found
     @classmethod
     def get_by_loc(cls, loc):
-        query = (cls
-                 .select()
-                 .where((ScannedLocation.latitude == loc[0]) &
-                        (ScannedLocation.longitude == loc[1]))
-                 .dicts())
+        def load():
+            query = (cls
+                     .select()
+                     .where((ScannedLocation.latitude == loc[0]) &
+                            (ScannedLocation.longitude == loc[1]))
+                     .dicts())
+
+            return query[0] if len(list(query)) else cls.new_loc(loc)
 
-        return query[0] if len(list(query)) else cls.new_loc(loc)
+        return scan_state.get_location(cellid(loc), load)
 
     # Check if spawn points in a list are in any of the existing spannedlocation records
     # Otherwise, search through the spawn point list, and update scan_spawn_point dict for DB bulk upserting
@@ -781,26 +986,39 @@ class ScannedLocation(BaseModel):
                         .join(cls)
                         .where(cls.cellid == cell).dicts())
         '''
-        query = (ScanSpawnPoint
-                 .select(ScanSpawnPoint.spawnpoint)
-                 .where(ScanSpawnPoint.scannedlocation == cell).dicts())
+        def load():
+            query = (ScanSpawnPoint
+                     .select(ScanSpawnPoint.spawnpoint)
+                     .where(ScanSpawnPoint.scannedlocation == cell).dicts())
 
-        return [i['spawnpoint'] for i in list(query)]
+            return [i['spawnpoint'] for i in list(query)]
+
+        return scan_state.get_links(cell, load)
+
+    # Load the links of many cells into the scan state store at once
+    @classmethod
+    def load_links(cls, cells, chunk_size=500):
+        links = dict((cell, []) for cell in cells)
+        cells = list(cells)
+        for i in range(0, len(cells), chunk_size):
+            query = (ScanSpawnPoint
+                     .select(ScanSpawnPoint.spawnpoint, ScanSpawnPoint.scannedlocation)
+                     .where(ScanSpawnPoint.scannedlocation << cells[i:i + chunk_size])
+                     .dicts())
+            for row in query:
+                links[row['scannedlocation']].append(row['spawnpoint'])
+
+        scan_state.load_links(links)
 
     # return list of dicts for upcoming valid band times
     @staticmethod
     def visible_forts(step_location):
-        distance = 0.9
-        n, e, s, w = hex_bounds(step_location, radius=distance * 1000)
-        for g in Gym.get_gyms(s, w, n, e).values():
-            if in_radius((g['latitude'], g['longitude']), step_location, distance):
-                return True
+        if not fort_presence.loaded:
+            fort_presence.load(itertools.chain(
+                Gym.select(Gym.gym_id, Gym.latitude, Gym.longitude).tuples(),
+                Pokestop.select(Pokestop.pokestop_id, Pokestop.latitude, Pokestop.longitude).tuples()))
 
-        for g in Pokestop.get_stops(s, w, n, e):
-            if in_radius((g['latitude'], g['longitude']), step_location, distance):
-                return True
-
-        return False
+        return fort_presence.any_within(step_location[0], step_location[1], 0.9)
 
     # return list of dicts for upcoming valid band times
     @classmethod
@@ -1044,19 +1262,33 @@ class SpawnPoint(BaseModel):
     earliest_unseen = IntegerField()
 
     class Meta:
-        indexes = ((('latitude', 'longitude'), False),)
+        indexes = ((('latitude', 'longitude', 'last_scanned'), False),)
         constraints = [Check('earliest_unseen >= 0'), Check('earliest_unseen < 3600'),
                        Check('latest_seen >= 0'), Check('latest_seen < 3600')]
 
     # Returns the spawn point dict from ID, or a new dict if not found
     @classmethod
     def get_by_id(cls, id, latitude=0, longitude=0):
-        query = (cls
-                 .select()
-                 .where(cls.id == id)
-                 .dicts())
+        sp = cls.get_by_ids([id]).get(id)
+        return sp if sp else cls.new_dict(id, latitude, longitude)
+
+    # Returns the spawn point dicts of the IDs known, by ID
+    @classmethod
+    def get_by_ids(cls, ids):
+        def load(ids):
+            query = (cls
+                     .select()
+                     .where(cls.id << ids)
+                     .dicts())
+
+            return dict((sp['id'], sp) for sp in query)
+
+        return scan_state.get_spawnpoints(ids, load)
 
-        return query[0] if query else {
+    # A spawn point dict for a spawn point not in the db yet
+    @staticmethod
+    def new_dict(id, latitude=0, longitude=0):
+        return {
             'id': id,
             'latitude': latitude,
             'longitude': longitude,
@@ -1143,6 +1375,86 @@ class SpawnPoint(BaseModel):
     def get_quartile(secs, sp):
         return int(((secs - sp['earliest_unseen'] + 15 * 60 + 3600 - 1) % 3600) / 15 / 60)
 
+    # Shape a spawnpoint for the map and the spawnpoint scheduler: 'time' is
+    # the spawn time in seconds after the hour, and spawnpoints spawning twice
+    # an hour (like 'shsh') are marked 'special'.
+    @classmethod
+    def map_dict(cls, sp):
+        d = {'spawnpoint_id': sp['id'],
+             'latitude': sp['latitude'],
+             'longitude': sp['longitude'],
+             'time': cls.start_end(sp)[0]}
+        kind = sp['kind']
+        if sum(1 for i in range(4) if kind[i] == 's' and kind[i - 1] == 'h') > 1:
+            d['special'] = True
+        return d
+
+    @classmethod
+    def get_spawnpoints(cls, swLat, swLng, neLat, neLng, timestamp=0, oSwLat=None, oSwLng=None, oNeLat=None, oNeLng=None):
+        query = cls.select(cls.id, cls.latitude, cls.longitude, cls.kind, cls.links,
+                           cls.latest_seen, cls.earliest_unseen)
+
+        if timestamp > 0:
+            changed = (cls.last_scanned > datetime.utcfromtimestamp(timestamp / 1000))
+            if oSwLat and oSwLng and oNeLat and oNeLng:
+                changed = changed | ~((cls.latitude >= oSwLat) &
+                                      (cls.longitude >= oSwLng) &
+                                      (cls.latitude <= oNeLat) &
+                                      (cls.longitude <= oNeLng))
+            query = query.where(changed &
+                                ((cls.latitude >= swLat) &
+                                 (cls.longitude >= swLng) &
+                                 (cls.latitude <= neLat) &
+                                 (cls.longitude <= neLng)))
+        elif oSwLat and oSwLng and oNeLat and oNeLng:
+            # Send spawnpoints in view but exclude those within old boundaries. Only send newly uncovered spawnpoints.
+            query = query.where(((cls.latitude >= swLat) &
+                                 (cls.longitude >= swLng) &
+                                 (cls.latitude <= neLat) &
+                                 (cls.longitude <= neLng)) &
+                                ~((cls.latitude >= oSwLat) &
+                                  (cls.longitude >= oSwLng) &
+                                  (cls.latitude <= oNeLat) &
+                                  (cls.longitude <= oNeLng)))
+        elif swLat and swLng and neLat and neLng:
+            query = query.where((cls.latitude <= neLat) &
+                                (cls.latitude >= swLat) &
+                                (cls.longitude >= swLng) &
+                                (cls.longitude <= neLng))
+
+        return [cls.map_dict(sp) for sp in query.dicts()]
+
+    @classmethod
+    def get_spawnpoints_in_hex(cls, center, steps):
+        log.info('Finding spawn points {} steps away'.format(steps))
+
+        n, e, s, w = hex_bounds(center, steps)
+
+        query = (cls
+                 .select(cls.id, cls.latitude, cls.longitude, cls.kind, cls.links,
+                         cls.latest_seen, cls.earliest_unseen)
+                 .where((cls.latitude <= n) &
+                        (cls.latitude >= s) &
+                        (cls.longitude >= w) &
+                        (cls.longitude <= e))
+                 .dicts())
+
+        # The distance between scan circles of radius 70 in a hex is 121.2436
+        # steps - 1 to account for the center circle then add 70 for the edge.
+        step_distance = ((steps - 1) * 121.2436) + 70
+        # Compare spawnpoint list to a circle with radius steps * 120.
+        # Uses the direct geopy distance between the center and the spawnpoint.
+        filtered = []
+
+        for sp in query:
+            if geopy.distance.distance(center, (sp['latitude'], sp['longitude'])).meters <= step_distance:
+                filtered.append({'spawnpoint_id': sp['id'],
+                                 'lat': sp['latitude'],
+                                 'lng': sp['longitude'],
+                                 'time': cls.start_end(sp)[0]})
+
+        return filtered
+
     @classmethod
     def select_in_hex(cls, center, steps):
         R = 6378.1  # km radius of the earth
@@ -1201,8 +1513,23 @@ class SpawnpointDetectionData(BaseModel):
     def set_default_earliest_unseen(sp):
         sp['earliest_unseen'] = (sp['latest_seen'] + 14 * 60) % 3600
 
+    # Returns the past sightings of the given spawnpoints, by spawnpoint ID
+    @classmethod
+    def get_history(cls, sp_ids):
+        history = dict((sp_id, []) for sp_id in sp_ids)
+        if sp_ids:
+            query = (cls
+                     .select()
+                     .where(cls.spawnpoint_id << list(sp_ids))
+                     .dicts())
+            for s in query:
+                history[s['spawnpoint_id']].append(s)
+
+        return history
+
+    # history is the spawnpoint's past sightings, if already loaded
     @classmethod
-    def classify(cls, sp, scan_loc, now_secs, sighting=None):
+    def classify(cls, sp, scan_loc, now_secs, sighting=None, history=None):
 
         # to reduce CPU usage, give an intial reading of 15 min spawns if not done with initial scan of location
         if not scan_loc['done']:
@@ -1217,9 +1544,12 @@ class SpawnpointDetectionData(BaseModel):
             return
 
         # get past sightings
-        query = list(cls.select()
-                        .where(cls.spawnpoint_id == sp['id'])
-                        .dicts())
+        if history is None:
+            query = list(cls.select()
+                            .where(cls.spawnpoint_id == sp['id'])
+                            .dicts())
+        else:
+            query = list(history)
 
         if sighting:
             query.append(sighting)
@@ -1424,6 +1754,48 @@ class GymDetails(BaseModel):
     last_scanned = DateTimeField(default=datetime.utcnow)
 
 
+# Sightings per species, bucketed by the hour and day of their disappear time.
+# Maintained by seen_stats_loop, so statistics don't group the pokemon table.
+class PokemonSeenHourly(BaseModel):
+    pokemon_id = IntegerField()
+    hour = DateTimeField()
+    count = IntegerField(default=0)
+
+    class Meta:
+        primary_key = CompositeKey('pokemon_id', 'hour')
+
+
+class PokemonSeenDaily(BaseModel):
+    pokemon_id = IntegerField()
+    day = DateTimeField()
+    count = IntegerField(default=0)
+
+    class Meta:
+        primary_key = CompositeKey('pokemon_id', 'day')
+
+
+class PokemonLastSeen(BaseModel):
+    pokemon_id = IntegerField(primary_key=True)
+    disappear_time = DateTimeField()
+    latitude = DoubleField()
+    longitude = DoubleField()
+
+
+# Sightings of a species at a spawnpoint per day of their disappear time,
+# counted by seen_stats_loop as the sightings pass its watermark. Purged with
+# the pokemon table.
+class PokemonAppearance(BaseModel):
+    pokemon_id = IntegerField()
+    spawnpoint_id = CharField(max_length=54)
+    day = DateTimeField(index=True)
+    latitude = DoubleField()
+    longitude = DoubleField()
+    count = IntegerField(default=0)
+
+    class Meta:
+        indexes = ((('pokemon_id', 'spawnpoint_id', 'day'), True),)
+
+
 def hex_bounds(center, steps=None, radius=None):
     # Make a box that is (70m * step_limit * 2) + 70m away from the center point
     # Rationale is that you need to travel
@@ -1436,7 +1808,7 @@ def hex_bounds(center, steps=None, radius=None):
 
 
 # todo: this probably shouldn't _really_ be in "models" anymore, but w/e
-def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue, api, now_date):
+def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue, api, now_date, encounter_queue=None):
     pokemons = {}
     pokestops = {}
     gyms = {}
@@ -1462,6 +1834,9 @@ def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue, a
         if config['parse_pokestops'] or config['parse_gyms']:
             forts += cell.get('forts', [])
 
+    if forts:
+        fort_presence.add((f['id'], f['latitude'], f['longitude']) for f in forts)
+
     # Check for a 0/0/0 bad scan
     # If we saw nothing and there should be visible forts, it's bad
     if not len(wild_pokemon) and not len(forts) and ScannedLocation.visible_forts(step_location):
@@ -1478,7 +1853,20 @@ def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue, a
         log.warning('Nothing on nearby_pokemons or wild. Speed violation?')
         log.info("Common causes: not using -speed, deleting or dropping the WorkerStatus table without waiting before restarting, or there really aren't any pokemon in 200m")
 
-    scan_loc = ScannedLocation.get_by_loc(step_location)
+    # Copies of the rows held by scan_state, which other search workers and
+    # the scheduler read meanwhile. They are put back once updated.
+    scan_loc = dict(ScannedLocation.get_by_loc(step_location))
+
+    # Load the spawnpoints seen here and the ones linked to this location in
+    # one go, with the past sightings classify will need.
+    linked_sp_ids = ScannedLocation.linked_spawn_points(scan_loc['cellid'])
+    all_sp_ids = set(p['spawn_point_id'] for p in wild_pokemon) | set(linked_sp_ids)
+    known_spawn_points = dict((sp_id, dict(sp)) for sp_id, sp in SpawnPoint.get_by_ids(all_sp_ids).iteritems())
+    history = {}
+    if scan_loc['done']:
+        history = SpawnpointDetectionData.get_history(
+            [sp_id for sp_id in all_sp_ids
+             if sp_id not in known_spawn_points or not SpawnPoint.tth_found(known_spawn_points[sp_id])])
 
     if len(wild_pokemon):
         encounter_ids = [b64encode(str(p['encounter_id'])) for p in wild_pokemon]
@@ -1489,23 +1877,20 @@ def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue, a
                  .dicts())
 
         # Store all encounter_ids and spawnpoint_id for the pokemon in query (all thats needed to make sure its unique).
-        encountered_pokemon = [(p['encounter_id'], p['spawnpoint_id']) for p in query]
+        encountered_pokemon = set((p['encounter_id'], p['spawnpoint_id']) for p in query)
 
-        for p in wild_pokemon:
+        # The ids are encoded once, above, and shared by every row built below.
+        for p, encounter_id in itertools.izip(wild_pokemon, encounter_ids):
 
-            sp = SpawnPoint.get_by_id(p['spawn_point_id'], p['latitude'], p['longitude'])
+            sp = known_spawn_points.get(p['spawn_point_id'])
+            if sp is None:
+                sp = SpawnPoint.new_dict(p['spawn_point_id'], p['latitude'], p['longitude'])
+                known_spawn_points[p['spawn_point_id']] = sp
             spawn_points[p['spawn_point_id']] = sp
             sp['missed_count'] = 0
 
-            sighting = {
-                'id': b64encode(str(p['encounter_id'])) + '_' + str(now_secs),
-                'encounter_id': b64encode(str(p['encounter_id'])),
-                'spawnpoint_id': p['spawn_point_id'],
-                'scan_time': now_date,
-                'tth_secs': None
-            }
-
             sp_id_list.append(p['spawn_point_id'])  # keep a list of sp_ids to return
+            tth_secs = None
 
             # time_till_hidden_ms was overflowing causing a negative integer.
             # It was also returning a value above 3.6M ms.
@@ -1513,7 +1898,7 @@ def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue, a
                 d_t_secs = date_secs(datetime.utcfromtimestamp((p['last_modified_timestamp_ms'] + p['time_till_hidden_ms']) / 1000.0))
                 if sp['latest_seen'] != sp['earliest_unseen']:
                     log.info('TTH found for spawnpoint %s', sp['id'])
-                    sighting['tth_secs'] = d_t_secs
+                    tth_secs = d_t_secs
                 sp['latest_seen'] = d_t_secs
                 sp['earliest_unseen'] = d_t_secs
 
@@ -1530,13 +1915,21 @@ def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue, a
                     log.warning('Redoing scan of this location to identify new spawnpoint.')
                     ScannedLocation.reset_bands(scan_loc)
 
-            if (not SpawnPoint.tth_found(sp) or sighting['tth_secs'] or not scan_loc['done']):
-                SpawnpointDetectionData.classify(sp, scan_loc, now_secs, sighting)
+            if (not SpawnPoint.tth_found(sp) or tth_secs or not scan_loc['done']):
+                sighting = {
+                    'id': encounter_id + '_' + str(now_secs),
+                    'encounter_id': encounter_id,
+                    'spawnpoint_id': p['spawn_point_id'],
+                    'scan_time': now_date,
+                    'tth_secs': tth_secs
+                }
+                SpawnpointDetectionData.classify(sp, scan_loc, now_secs, sighting,
+                                                 history.get(sp['id']))
                 sightings[p['encounter_id']] = sighting
 
             sp['last_scanned'] = datetime.utcfromtimestamp(p['last_modified_timestamp_ms'] / 1000.0)
 
-            if (b64encode(str(p['encounter_id'])), p['spawn_point_id']) in encountered_pokemon:
+            if (encounter_id, p['spawn_point_id']) in encountered_pokemon:
                 # If pokemon has been encountered before dont process it.
                 skipped += 1
                 continue
@@ -1546,27 +1939,8 @@ def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue, a
 
             printPokemon(p['pokemon_data']['pokemon_id'], p['latitude'], p['longitude'], disappear_time)
 
-            # Scan for IVs and moves.
-            encounter_result = None
-            if (args.encounter and (p['pokemon_data']['pokemon_id'] in args.encounter_whitelist or
-                                    p['pokemon_data']['pokemon_id'] not in args.encounter_blacklist and not args.encounter_whitelist)):
-                time.sleep(args.encounter_delay)
-                # Set up encounter request envelope
-                req = api.create_request()
-                encounter_result = req.encounter(encounter_id=p['encounter_id'],
-                                                 spawn_point_id=p['spawn_point_id'],
-                                                 player_latitude=step_location[0],
-                                                 player_longitude=step_location[1])
-                encounter_result = req.check_challenge()
-                encounter_result = req.get_hatched_eggs()
-                encounter_result = req.get_inventory()
-                encounter_result = req.check_awarded_badges()
-                encounter_result = req.download_settings()
-                encounter_result = req.get_buddy_walked()
-                encounter_result = req.call()
-
             pokemons[p['encounter_id']] = {
-                'encounter_id': b64encode(str(p['encounter_id'])),
+                'encounter_id': encounter_id,
                 'spawnpoint_id': p['spawn_point_id'],
                 'pokemon_id': p['pokemon_data']['pokemon_id'],
                 'latitude': p['latitude'],
@@ -1579,26 +1953,24 @@ def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue, a
                 'move_2': None
             }
 
-            if encounter_result is not None and 'wild_pokemon' in encounter_result['responses']['ENCOUNTER']:
-                pokemon_info = encounter_result['responses']['ENCOUNTER']['wild_pokemon']['pokemon_data']
-                pokemons[p['encounter_id']].update({
-                    'individual_attack': pokemon_info.get('individual_attack', 0),
-                    'individual_defense': pokemon_info.get('individual_defense', 0),
-                    'individual_stamina': pokemon_info.get('individual_stamina', 0),
-                    'move_1': pokemon_info['move_1'],
-                    'move_2': pokemon_info['move_2'],
-                })
-
+            webhook = None
             if args.webhooks:
-
-                wh_poke = pokemons[p['encounter_id']].copy()
-                wh_poke.update({
+                webhook = {
                     'disappear_time': calendar.timegm(disappear_time.timetuple()),
                     'last_modified_time': p['last_modified_timestamp_ms'],
                     'time_until_hidden_ms': p['time_till_hidden_ms']
-                })
+                }
+
+                wh_poke = dict(pokemons[p['encounter_id']], **webhook)
                 wh_update_queue.put(('pokemon', wh_poke))
 
+            # Scan for IVs and moves. The sighting goes out right away, the
+            # encounter workers merge the stats into it when they get them.
+            if (encounter_queue is not None and args.encounter and
+                    (p['pokemon_data']['pokemon_id'] in args.encounter_whitelist or
+                     p['pokemon_data']['pokemon_id'] not in args.encounter_blacklist and not args.encounter_whitelist)):
+                encounter_queue.put(api, step_location, p, pokemons[p['encounter_id']], webhook)
+
     if len(forts):
         if config['parse_pokestops']:
             stop_ids = [f['id'] for f in forts if f.get('type') == 1]
@@ -1699,12 +2071,12 @@ def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue, a
     log.debug('Skipped %d Pokemons and %d pokestops.', skipped, stopsskipped)
 
     # look for spawnpoints within scan_loc that are not here to see if can narrow down tth window
-    for sp_id in ScannedLocation.linked_spawn_points(scan_loc['cellid']):
+    for sp_id in linked_sp_ids:
         if sp_id in sp_id_list:
             sp = spawn_points[sp_id]
         # not seen and not a speed violation
         else:
-            sp = SpawnPoint.get_by_id(sp_id)
+            sp = known_spawn_points.get(sp_id) or SpawnPoint.new_dict(sp_id)
             if SpawnpointDetectionData.unseen(sp, now_secs):
                 spawn_points[sp['id']] = sp
             endpoints = SpawnPoint.start_end(sp, args.spawn_delay)
@@ -1721,7 +2093,7 @@ def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue, a
                         sp['id'], (sp['earliest_unseen'] - sp['latest_seen']) % 3600)
             log.info('Embiggening search for TTH by 15 minutes to try again')
             if sp_id not in sp_id_list:
-                SpawnpointDetectionData.classify(sp, scan_loc, now_secs)
+                SpawnpointDetectionData.classify(sp, scan_loc, now_secs, history=history.get(sp_id))
             sp['latest_seen'] = (sp['latest_seen'] - 60) % 3600
             sp['earliest_unseen'] = (sp['earliest_unseen'] + 14 * 60) % 3600
             spawn_points[sp_id] = sp
@@ -1736,7 +2108,10 @@ def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue, a
         db_update_queue.put((Pokestop, pokestops))
     if len(gyms):
         db_update_queue.put((Gym, gyms))
+    scan_state.put_location(scan_loc)
     if len(spawn_points):
+        scan_state.put_spawnpoints(spawn_points.values())
+        scan_state.add_links(scan_spawn_points.values())
         db_update_queue.put((SpawnPoint, spawn_points))
         db_update_queue.put((ScanSpawnPoint, scan_spawn_points))
         if len(sightings):
@@ -1755,6 +2130,12 @@ def parse_gyms(args, gym_responses, wh_update_queue):
     gym_members = {}
     gym_pokemon = {}
     trainers = {}
+    gym_locations = []
+    rosters = {}
+
+    # Truncated, so the value cached in gym_rosters matches what the database stores.
+    details_scanned = datetime.utcnow().replace(microsecond=0)
+    members_scanned = datetime.utcnow()
 
     i = 0
     for g in gym_responses.values():
@@ -1766,6 +2147,15 @@ def parse_gyms(args, gym_responses, wh_update_queue):
             'name': g['name'],
             'description': g.get('description'),
             'url': g['urls'][0],
+            'last_scanned': details_scanned,
+        }
+
+        rosters[gym_id] = {
+            'gym_id': gym_id,
+            'name': g['name'],
+            'description': g.get('description'),
+            'last_scanned': details_scanned,
+            'members': [],
         }
 
         if args.webhooks:
@@ -1780,12 +2170,30 @@ def parse_gyms(args, gym_responses, wh_update_queue):
                 'pokemon': [],
             }
 
+        gym_locations.append(gym_state['fort_data'])
+
         for member in gym_state.get('memberships', []):
             gym_members[i] = {
                 'gym_id': gym_id,
                 'pokemon_uid': member['pokemon_data']['id'],
+                'last_scanned': members_scanned,
             }
 
+            rosters[gym_id]['members'].append({
+                'last_scanned': members_scanned,
+                'pokemon_cp': member['pokemon_data']['cp'],
+                'pokemon_id': member['pokemon_data']['pokemon_id'],
+                'pokemon_name': get_pokemon_name(member['pokemon_data']['pokemon_id']),
+                'pokemon_uid': member['pokemon_data']['id'],
+                'move_1': member['pokemon_data'].get('move_1'),
+                'move_2': member['pokemon_data'].get('move_2'),
+                'iv_attack': member['pokemon_data'].get('individual_attack', 0),
+                'iv_defense': member['pokemon_data'].get('individual_defense', 0),
+                'iv_stamina': member['pokemon_data'].get('individual_stamina', 0),
+                'trainer_name': member['trainer_public_profile']['name'],
+                'trainer_level': member['trainer_public_profile']['level'],
+            })
+
             gym_pokemon[i] = {
                 'pokemon_uid': member['pokemon_data']['id'],
                 'pokemon_id': member['pokemon_data']['pokemon_id'],
@@ -1844,10 +2252,11 @@ def parse_gyms(args, gym_responses, wh_update_queue):
     #
     # We _could_ synchronously upsert GymDetails, then queue the other tables for
     # upsert, but that would put that Gym's overall information in a weird non-atomic state.
+    #
+    # GymDetails goes last: its last_scanned tells readers (and the roster caches of other
+    # instances) that the members are there.
 
     # Upsert all the models.
-    if len(gym_details):
-        bulk_upsert(GymDetails, gym_details)
     if len(gym_pokemon):
         bulk_upsert(GymPokemon, gym_pokemon)
     if len(trainers):
@@ -1864,11 +2273,47 @@ def parse_gyms(args, gym_responses, wh_update_queue):
         if len(gym_members):
             bulk_upsert(GymMember, gym_members)
 
+    if len(gym_details):
+        bulk_upsert(GymDetails, gym_details)
+
+    for gym_id, roster in rosters.iteritems():
+        roster['members'].sort(key=lambda m: m['pokemon_cp'], reverse=True)
+        gym_rosters.set(gym_id, roster)
+
+    response_cache.invalidate(gym_locations)
+
+    if len(stream_broker):
+        # Only the details scan knows names and members, clients merge these
+        # into the gyms they already have.
+        updates = []
+        for fort in gym_locations:
+            roster = rosters[fort['id']]
+            updates.append({
+                'gym_id': fort['id'],
+                'latitude': fort['latitude'],
+                'longitude': fort['longitude'],
+                'name': roster['name'],
+                'pokemon': [{
+                    'gym_id': fort['id'],
+                    'pokemon_cp': m['pokemon_cp'],
+                    'pokemon_id': m['pokemon_id'],
+                    'pokemon_name': m['pokemon_name'],
+                    'trainer_name': m['trainer_name'],
+                    'trainer_level': m['trainer_level'],
+                } for m in reversed(roster['members'])],
+            })
+        stream_broker.publish('gyms', stream_rows(updates))
+
     log.info('Upserted %d gyms and %d gym members',
              len(gym_details),
              len(gym_members))
 
 
+# The models /raw_data returns, writes to other tables leave its cached
+# responses be.
+map_models = (Pokemon, Pokestop, Gym, ScannedLocation, SpawnPoint)
+
+
 def db_updater(args, q):
     # The forever loop.
     while True:
@@ -1883,98 +2328,748 @@ def db_updater(args, q):
 
             # Loop the queue.
             while True:
-                model, data = q.get()
-                bulk_upsert(model, data)
-                q.task_done()
-                log.debug('Upserted to %s, %d records (upsert queue remaining: %d)',
-                          model.__name__,
-                          len(data),
-                          q.qsize())
+                batch = collect_updates(q, args.db_flush_interval)
+                updates = coalesce_updates(batch)
+
+                if args.db_type == 'sqlite':
+                    # The only writer, so everything goes in one transaction.
+                    units = [updates.items()]
+                else:
+                    units = [[(model, rows)] for model, rows in updates.iteritems()]
+
+                for unit in units:
+                    if commit_updates(unit):
+                        for model, rows in unit:
+                            updates_committed(model, rows)
+                            log.debug('Upserted to %s, %d records (upsert queue remaining: %d)',
+                                      model.__name__,
+                                      len(rows),
+                                      q.qsize())
+                for i in range(len(batch)):
+                    q.task_done()
+
                 if q.qsize() > 50:
-                    log.warning("DB queue is > 50 (@%d); try increasing --db-threads", q.qsize())
+                    if args.db_type == 'sqlite':
+                        log.warning("DB queue is > 50 (@%d); SQLite can't keep up, consider MySQL", q.qsize())
+                    else:
+                        log.warning("DB queue is > 50 (@%d); try increasing --db-threads", q.qsize())
 
         except Exception as e:
             log.exception('Exception in db_updater: %s', e)
 
 
+# Take the next queued update, plus whatever else is queued within
+# flush_interval seconds, up to max_rows rows.
+def collect_updates(q, flush_interval, max_rows=5000):
+    batch = [q.get()]
+    rows = len(batch[0][1])
+    deadline = time.time() + flush_interval
+
+    while rows < max_rows:
+        try:
+            timeout = deadline - time.time()
+            if timeout > 0:
+                batch.append(q.get(timeout=timeout))
+            else:
+                batch.append(q.get_nowait())
+        except Empty:
+            break
+        rows += len(batch[-1][1])
+
+    return batch
+
+
+def primary_key_names(model):
+    pk = model._meta.primary_key
+    if not pk:
+        return []
+    return pk.field_names if isinstance(pk, CompositeKey) else [pk.name]
+
+
+# Merge queued (model, {key: row}) updates into the list of rows to write per
+# model, in queue order. Rows with the same primary key are written once,
+# with the last queued version. As in the upsert, a NULL in one of the
+# model's Meta.upsert_coalesce columns keeps the value queued before it.
+def coalesce_updates(batch):
+    merged = OrderedDict()
+    for model, data in batch:
+        rows = merged.setdefault(model, OrderedDict())
+        names = primary_key_names(model)
+        coalesce = getattr(model._meta, 'upsert_coalesce', ())
+        for row in data.itervalues():
+            if names and all(name in row for name in names):
+                key = tuple(row[name] for name in names)
+            else:
+                key = id(row)
+            earlier = rows.pop(key, None)
+            if earlier is not None and coalesce:
+                kept = dict((name, earlier[name]) for name in coalesce
+                            if row.get(name) is None and earlier.get(name) is not None)
+                if kept:
+                    # A copy, the queued row may be shared.
+                    row = dict(row, **kept)
+            rows[key] = row
+
+    return OrderedDict((model, rows.values()) for model, rows in merged.iteritems())
+
+
+# Write updates, as [(model, rows)], in one transaction. A deadlock or a lost
+# connection rolls back everything written in it, so the whole transaction is
+# retried with a growing delay. Returns whether it was committed, its rows go
+# to dead_letters when it wasn't.
+def commit_updates(updates, retries=3):
+    attempt = 0
+    while True:
+        try:
+            with flaskDb.database.atomic():
+                for model, rows in updates:
+                    upsert_rows(model, rows)
+            return True
+        except Exception as e:
+            if attempt >= retries:
+                log.warning('%s. Giving up on %s.', e,
+                            ', '.join('%d %s rows' % (len(rows), model.__name__) for model, rows in updates))
+                for model, rows in updates:
+                    for row in rows:
+                        dead_letters.append((model, row, str(e), True))
+                return False
+
+            attempt += 1
+            log.warning('%s... Retrying', e)
+            time.sleep(0.5 * 2 ** attempt)
+
+
+def upsert_rows(model, rows):
+    if model is Pokemon:
+        # Stamp here, so the index and the table agree on last_modified.
+        now_date = datetime.utcnow()
+        for p in rows:
+            p['last_modified'] = now_date
+
+    for same_shape in group_by_shape(rows):
+        bulk_upsert(model, dict(enumerate(same_shape)), retries=None)
+
+
+# Bring the in-memory copies and the map clients up to date with rows that
+# have been committed.
+def updates_committed(model, rows):
+    if model is Pokemon and pokemon_index.ready:
+        pokemon_index.upsert(rows)
+    if model in map_models:
+        response_cache.invalidate(rows)
+    publish_changes(model, rows)
+
+
+# A multi-row insert takes its columns from the first row, so rows queued by
+# different producers are written per set of columns.
+def group_by_shape(rows):
+    shapes = OrderedDict()
+    for row in rows:
+        shapes.setdefault(frozenset(row), []).append(row)
+    return shapes.values()
+
+
+# Push committed rows to the /stream clients, in the shape raw_data returns.
+def publish_changes(model, rows):
+    if not len(stream_broker) or not rows:
+        return
+
+    # Copies, the transform and the species fields would change the rows
+    # that were written.
+    rows = stream_rows([dict(row) for row in rows])
+    if model is Pokemon:
+        for p in rows:
+            species = get_species(p['pokemon_id'])
+            p['pokemon_name'] = species.name
+            p['pokemon_rarity'] = species.rarity
+            p['pokemon_types'] = species.types
+        stream_broker.publish('pokemon', rows)
+    elif model is Pokestop:
+        stream_broker.publish('pokestops', rows)
+    elif model is Gym:
+        stream_broker.publish('gyms', rows)
+    elif model is ScannedLocation:
+        stream_broker.publish('scanned', rows)
+
+
+def publish_expired(pokemons):
+    if len(stream_broker):
+        expired = [{'encounter_id': p['encounter_id'],
+                    'latitude': p['latitude'],
+                    'longitude': p['longitude']} for p in pokemons]
+        stream_broker.publish('expired', stream_rows(expired))
+
+
+# Rows in the coordinates the map uses, like the getters return them. The
+# rows are changed in place.
+def stream_rows(rows):
+    if args.china:
+        return list(transform_rows_from_wgs_to_gcj(rows))
+    return rows
+
+
+def pokemon_index_loop(args):
+    # Pokemon parsed by this process are fed in by db_updater, this picks up
+    # the ones written by other instances sharing the database.
+    pokemon_index.on_expire = publish_expired
+    last_sync = None
+    while True:
+        try:
+            sync_date = datetime.utcnow()
+            query = (Pokemon
+                     .select()
+                     .where(Pokemon.disappear_time > sync_date))
+            if last_sync:
+                # Overlap a minute to survive clock drift between instances.
+                query = query.where(Pokemon.last_modified > last_sync - timedelta(minutes=1))
+
+            pokemons = list(query.dicts())
+            new = set(pokemon_index.upsert(pokemons))
+            pokemons = [p for p in pokemons if p['encounter_id'] in new]
+            response_cache.invalidate(pokemons)
+            publish_changes(Pokemon, pokemons)
+            if not pokemon_index.ready:
+                log.info('Loaded %d active Pokemon into the in-memory index', len(pokemon_index))
+                pokemon_index.ready = True
+            last_sync = sync_date
+        except Exception as e:
+            log.exception('Exception in pokemon_index_loop: %s', e)
+
+        time.sleep(args.pokemon_index_refresh)
+
+
+def add_seen_counts(model, field, deltas):
+    for (pokemon_id, bucket), count in deltas.iteritems():
+        updated = (model
+                   .update(count=model.count + count)
+                   .where((model.pokemon_id == pokemon_id) & (field == bucket))
+                   .execute())
+        if not updated:
+            InsertQuery(model, {model.pokemon_id: pokemon_id, field: bucket, model.count: count}).execute()
+
+
+def add_appearance_counts(appearances):
+    for row in appearances.itervalues():
+        updated = (PokemonAppearance
+                   .update(count=PokemonAppearance.count + row['count'])
+                   .where((PokemonAppearance.pokemon_id == row['pokemon_id']) &
+                          (PokemonAppearance.spawnpoint_id == row['spawnpoint_id']) &
+                          (PokemonAppearance.day == row['day']))
+                   .execute())
+        if not updated:
+            InsertQuery(PokemonAppearance, row).execute()
+
+
+# The seen statistics hold the sightings that disappeared up to this unix
+# time, kept in the versions table so every instance shares it.
+def get_seen_watermark():
+    return Versions.get(Versions.key == 'seen_stats_until').val
+
+
+# Sightings are counted once they are this far gone, when the updaters are done
+# writing them.
+seen_stats_margin = timedelta(minutes=10)
+
+
+# Count the sightings that disappeared after the watermark into the seen
+# statistics, at most an hour of them at a time, and move the watermark past
+# them. Returns whether there is more to count.
+def add_seen_window():
+    watermark = get_seen_watermark()
+    start = datetime.utcfromtimestamp(watermark)
+    until = datetime.utcnow().replace(microsecond=0) - seen_stats_margin
+    if start >= until:
+        return False
+
+    # Skip the hours nothing was seen in, all of them on a new database.
+    first = (Pokemon
+             .select(fn.MIN(Pokemon.disappear_time))
+             .where(Pokemon.disappear_time > start)
+             .scalar(convert=True))
+    if first is None or first >= until:
+        end = until
+    else:
+        end = min(until, hour_bucket(first) + timedelta(hours=1))
+
+    query = (Pokemon
+             .select(Pokemon.pokemon_id,
+                     Pokemon.spawnpoint_id,
+                     Pokemon.disappear_time,
+                     Pokemon.latitude,
+                     Pokemon.longitude)
+             .where((Pokemon.disappear_time > start) &
+                    (Pokemon.disappear_time <= end))
+             .dicts())
+    hourly, daily, last_seen, appearances = count_sightings(query)
+
+    with flaskDb.database.transaction():
+        # Claim the window first. Another instance counting it at the same time
+        # waits on the row and then finds it moved, so each sighting is counted
+        # exactly once.
+        claimed = (Versions
+                   .update(val=calendar.timegm(end.timetuple()))
+                   .where((Versions.key == 'seen_stats_until') &
+                          (Versions.val == watermark))
+                   .execute())
+        if not claimed:
+            return True
+
+        add_seen_counts(PokemonSeenHourly, PokemonSeenHourly.hour, hourly)
+        add_seen_counts(PokemonSeenDaily, PokemonSeenDaily.day, daily)
+
+        if last_seen:
+            newer = {}
+            current = (PokemonLastSeen
+                       .select(PokemonLastSeen.pokemon_id, PokemonLastSeen.disappear_time)
+                       .where(PokemonLastSeen.pokemon_id << last_seen.keys())
+                       .dicts())
+            current = dict((p['pokemon_id'], p['disappear_time']) for p in current)
+            for pokemon_id, row in last_seen.iteritems():
+                if pokemon_id not in current or current[pokemon_id] < row['disappear_time']:
+                    newer[pokemon_id] = row
+            if newer:
+                bulk_upsert(PokemonLastSeen, newer, retries=None)
+
+        add_appearance_counts(appearances)
+
+    log.debug('Added %d sightings up to %s to the seen statistics', sum(daily.values()), end)
+
+    return end < until
+
+
+# Keeps the seen statistics up to date from the committed sightings. Catching
+# up, e.g. on a database that has just been migrated, goes an hour of
+# sightings at a time without waiting.
+def seen_stats_loop(args):
+    while True:
+        try:
+            behind = add_seen_window()
+        except Exception as e:
+            log.exception('Exception in seen_stats_loop: %s', e)
+            behind = False
+
+        if not behind:
+            time.sleep(60)
+
+
+# Tables kept in daily partitions with --db-partitions, and the column they
+# are partitioned on. Queries for a time window only read the partitions it
+# covers, and purging old rows drops whole partitions instead of deleting
+# them row by row. Pokemon isn't one: its disappear_time changes when a
+# spawnpoint's timer is found, and with the column in the primary key the
+# upsert would insert a second row for the same encounter.
+def partitioned_tables():
+    return ((SpawnpointDetectionData, 'scan_time'),)
+
+
+def use_partitions(args):
+    return args.db_partitions and args.db_type == 'mysql'
+
+
+# MySQL's TO_DAYS() of a date.
+def to_days(day):
+    return day.toordinal() + 365
+
+
+def table_partitions(db, table):
+    cursor = db.execute_sql('SELECT partition_name, partition_description '
+                            'FROM information_schema.partitions '
+                            'WHERE table_schema = DATABASE() AND table_name = %s '
+                            'AND partition_name IS NOT NULL', (table,))
+    return dict(cursor.fetchall())
+
+
+# Turn the tables into partitioned ones, if they aren't yet. MySQL wants the
+# partitioning column in the primary key. A sighting's scan_time is set when
+# it is made and its row is only ever inserted, so this doesn't change what
+# a key matches.
+def partition_tables(db, days_ahead=3):
+    today = datetime.utcnow().date()
+    for model, column in partitioned_tables():
+        table = model._meta.db_table
+        if table_partitions(db, table):
+            continue
+
+        log.info('Partitioning table %s by day, this can take a while on a large table.', table)
+        db.execute_sql('ALTER TABLE `{table}` DROP PRIMARY KEY, ADD PRIMARY KEY (`{pk}`, `{column}`) '
+                       'PARTITION BY RANGE (TO_DAYS(`{column}`)) ('
+                       'PARTITION p_old VALUES LESS THAN ({today}), '
+                       'PARTITION p_future VALUES LESS THAN MAXVALUE)'.format(
+                           table=table, pk=model._meta.primary_key.db_column,
+                           column=column, today=to_days(today)))
+
+    add_partitions(db, days_ahead)
+
+
+# Split a partition per day off p_future, up to days_ahead days from now.
+# Rows past the last day still land in p_future, so a stopped cleaner only
+# delays the split.
+def add_partitions(db, days_ahead=3):
+    today = datetime.utcnow().date()
+    for model, column in partitioned_tables():
+        table = model._meta.db_table
+        partitions = table_partitions(db, table)
+        if not partitions:
+            continue
+
+        last = max(int(d) for d in partitions.values() if d != 'MAXVALUE')
+        days = [today + timedelta(days=n) for n in range(days_ahead + 1)]
+        days = [d for d in days if to_days(d + timedelta(days=1)) > last]
+        if not days:
+            continue
+
+        ranges = ['PARTITION p{} VALUES LESS THAN ({})'.format(
+            d.strftime('%Y%m%d'), to_days(d + timedelta(days=1))) for d in days]
+        db.execute_sql('ALTER TABLE `{}` REORGANIZE PARTITION p_future INTO ({}, '
+                       'PARTITION p_future VALUES LESS THAN MAXVALUE)'.format(
+                           table, ', '.join(ranges)))
+        log.debug('Added %d partitions to table %s', len(days), table)
+
+
+# Drop the partitions only holding rows from before the given time. Returns
+# how many were dropped.
+def drop_partitions(db, model, before):
+    table = model._meta.db_table
+    bound = to_days(before.date())
+    old = [name for name, d in table_partitions(db, table).iteritems()
+           if d != 'MAXVALUE' and int(d) <= bound]
+    if old:
+        db.execute_sql('ALTER TABLE `{}` DROP PARTITION {}'.format(table, ', '.join(old)))
+        log.info('Dropped %d old partitions of table %s', len(old), table)
+    return len(old)
+
+
+# Applies retention rules in small batches of rows, in primary key order,
+# within a rows per second budget, so cleaning never holds long locks on the
+# tables the map and the db updaters use. Keeps what each rule did last pass.
+class Cleaner(object):
+
+    def __init__(self, rate, batch_size=500):
+        self.rate = rate
+        self.batch_size = batch_size
+        # Rule name -> the last run's rows, batches, seconds and last_run,
+        # and total_rows, total_seconds and runs since start.
+        self.stats = OrderedDict()
+
+    # Delete the rows of model matching where, or set the values in update
+    # on them. Returns the number of rows changed.
+    def run(self, name, model, where, update=None):
+        pk = model._meta.primary_key
+        start = time.time()
+        rows = batches = 0
+        last = None
+        while True:
+            query = model.select(pk).where(where)
+            if last is not None:
+                query = query.where(pk > last)
+            ids = [r[0] for r in query.order_by(pk).limit(self.batch_size).tuples()]
+            if not ids:
+                break
+
+            # Checking the rule again skips rows changed since the select.
+            if update:
+                query = model.update(**update)
+            else:
+                query = model.delete()
+            query.where(where & (pk << ids)).execute()
+
+            rows += len(ids)
+            batches += 1
+            last = ids[-1]
+            log.debug('Cleaning %s, %d rows so far', name, rows)
+            if len(ids) < self.batch_size:
+                break
+
+            if self.rate > 0:
+                ahead = float(rows) / self.rate - (time.time() - start)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+        seconds = time.time() - start
+        stats = self.stats.setdefault(name, {'total_rows': 0, 'total_seconds': 0.0, 'runs': 0})
+        stats.update({'rows': rows, 'batches': batches, 'seconds': seconds,
+                      'last_run': datetime.utcnow()})
+        stats['total_rows'] += rows
+        stats['total_seconds'] += seconds
+        stats['runs'] += 1
+        log.debug('Cleaned %d rows of %s in %d batches (%.1fs)', rows, name, batches, seconds)
+        return rows
+
+    # The last run of each rule, with its totals since start, on one line.
+    def summary(self):
+        return '; '.join(
+            '%s: %d rows (%.1fs), %d in %d runs (%.1fs)' % (
+                name, s['rows'], s['seconds'], s['total_rows'], s['runs'], s['total_seconds'])
+            for name, s in self.stats.iteritems())
+
+
 def clean_db_loop(args):
+    db = flaskDb.database
+    cleaner = Cleaner(args.db_cleanup_rate)
     while True:
         try:
-            query = (MainWorker
-                     .delete()
-                     .where((ScannedLocation.last_modified <
-                             (datetime.utcnow() - timedelta(minutes=30)))))
-            query.execute()
-
-            query = (WorkerStatus
-                     .delete()
-                     .where((ScannedLocation.last_modified <
-                             (datetime.utcnow() - timedelta(minutes=30)))))
-            query.execute()
+            now_date = datetime.utcnow()
+            cleaner.run('idle main workers', MainWorker,
+                        MainWorker.last_modified < now_date - timedelta(minutes=30))
+            cleaner.run('idle worker status', WorkerStatus,
+                        WorkerStatus.last_modified < now_date - timedelta(minutes=30))
 
             # Remove active modifier from expired lured pokestops.
-            query = (Pokestop
-                     .update(lure_expiration=None, active_fort_modifier=None)
-                     .where(Pokestop.lure_expiration < datetime.utcnow()))
-            query.execute()
+            cleaner.run('expired lures', Pokestop,
+                        Pokestop.lure_expiration < now_date,
+                        update={'lure_expiration': None, 'active_fort_modifier': None})
+
+            replay_dead_letters()
+
+            if use_partitions(args):
+                add_partitions(db)
 
             # If desired, clear old pokemon spawns.
             if args.purge_data > 0:
-                query = (Pokemon
-                         .delete()
-                         .where((Pokemon.disappear_time <
-                                (datetime.utcnow() - timedelta(hours=args.purge_data)))))
-                query.execute()
-
-            log.info('Regular database cleaning complete')
-            time.sleep(60)
+                before = now_date - timedelta(hours=args.purge_data)
+                cleaner.run('old pokemon', Pokemon, Pokemon.disappear_time < before)
+                # The days of appearances entirely before the cutoff.
+                cleaner.run('old appearances', PokemonAppearance,
+                            PokemonAppearance.day <= before - timedelta(days=1))
+
+            # With partitions, whole days go first and the rest only reads
+            # the oldest one left.
+            if args.purge_detection_data > 0:
+                before = now_date - timedelta(hours=args.purge_detection_data)
+                if use_partitions(args):
+                    drop_partitions(db, SpawnpointDetectionData, before)
+                cleaner.run('old spawnpoint sightings', SpawnpointDetectionData,
+                            SpawnpointDetectionData.scan_time < before)
+
+            log.info('Regular database cleaning complete. %s', cleaner.summary())
         except Exception as e:
             log.exception('Exception in clean_db_loop: %s', e)
 
+        time.sleep(60)
 
-def bulk_upsert(cls, data):
-    num_rows = len(data.values())
-    i = 0
 
-    if args.db_type == 'mysql':
-        step = 120
-    else:
-        # SQLite has a default max number of parameters of 999,
-        # so we need to limit how many rows we insert for it.
-        step = 50
+# Most bind parameters one statement may have: SQLite's default
+# SQLITE_MAX_VARIABLE_NUMBER, and MySQL's 16 bit placeholder count.
+MAX_PARAMETERS = {'sqlite': 999, 'mysql': 65535}
+
+
+# Sizes bulk_upsert batches per model. A batch never has more rows than fit
+# the backend's parameter limit for the model's columns; within that, it is
+# halved when a statement takes longer than the target and grown back while
+# full batches stay well under it.
+class BatchSizer(object):
+
+    def __init__(self, target=0.25, min_rows=10, max_rows=1000):
+        self.target = target
+        self.min_rows = min_rows
+        self.max_rows = max_rows
+        self.steps = {}
+        self.lock = threading.Lock()
+
+    def limit(self, cls):
+        # Columns missing from a row are filled in from their defaults, so
+        # every field takes a parameter.
+        parameters = MAX_PARAMETERS.get(args.db_type, MAX_PARAMETERS['sqlite'])
+        return max(1, min(self.max_rows, parameters // len(cls._meta.sorted_fields)))
+
+    def step(self, cls):
+        return self.steps.get(cls) or self.limit(cls)
+
+    def record(self, cls, rows, seconds):
+        with self.lock:
+            limit = self.limit(cls)
+            step = self.steps.get(cls) or limit
+            if seconds > self.target and rows * 2 > step:
+                step = max(min(self.min_rows, limit), step // 2)
+            elif seconds < self.target / 2 and rows >= step:
+                step = min(limit, step + max(1, step // 4))
+            self.steps[cls] = step
+
+
+batch_sizer = BatchSizer()
+
+# Rows bulk_upsert gave up on, as (model, row, error, recoverable). Bounded,
+# the oldest are dropped first.
+dead_letters = deque(maxlen=10000)
+
+
+def is_unrecoverable(error):
+    # if there is a DB table constraint error, dump the data and don't retry
+    # unrecoverable error strings:
+    unrecoverable = ['constraint', 'has no attribute', 'peewee.IntegerField object at']
+    return any(x in str(error) for x in unrecoverable)
+
+
+# Write rows in batches sized by batch_sizer. Failing batches are retried a
+# few times with a growing delay, batches failing on bad data are split to
+# find the offending rows. Rows that can't be written go to dead_letters
+# instead of holding up the caller. Inside a transaction, pass retries=None:
+# database errors are raised instead, as the transaction has to be retried
+# as a whole.
+def bulk_upsert(cls, data, retries=3):
+    rows = data.values()
+    num_rows = len(rows)
+    i = 0
 
     while i < num_rows:
-        log.debug('Inserting items %d to %d', i, min(i + step, num_rows))
+        step = batch_sizer.step(cls)
+        batch = rows[i:i + step]
+        log.debug('Inserting items %d to %d', i, i + len(batch))
+        upsert_batch(cls, batch, retries)
+        i += len(batch)
+
+
+def upsert_batch(cls, batch, retries):
+    attempt = 0
+    while True:
         try:
-            InsertQuery(cls, rows=data.values()[i:min(i + step, num_rows)]).upsert().execute()
-        except Exception as e:
-            # if there is a DB table constraint error, dump the data and don't retry
-            # unrecoverable error strings:
-            unrecoverable = ['constraint', 'has no attribute', 'peewee.IntegerField object at']
-            has_unrecoverable = filter(lambda x: x in str(e), unrecoverable)
-            if has_unrecoverable:
-                log.warning('%s. Data is:', e)
-                log.warning(data.items())
+            start = time.time()
+            if args.db_type == 'mysql' or (SQLITE_UPSERT and primary_key_names(cls)):
+                insert_on_duplicate(cls, batch)
             else:
-                log.warning('%s... Retrying', e)
-                time.sleep(1)
+                fill_coalesced(cls, batch)
+                InsertQuery(cls, rows=batch).upsert().execute()
+            batch_sizer.record(cls, len(batch), time.time() - start)
+            return
+        except Exception as e:
+            if is_unrecoverable(e):
+                if len(batch) > 1:
+                    half = len(batch) // 2
+                    upsert_batch(cls, batch[:half], retries)
+                    upsert_batch(cls, batch[half:], retries)
+                else:
+                    log.warning('%s. Data is:', e)
+                    log.warning(batch)
+                    dead_letters.append((cls, batch[0], str(e), False))
+                return
+
+            if retries is None:
+                raise
+
+            if attempt >= retries:
+                log.warning('%s. Giving up on %d %s rows.', e, len(batch), cls.__name__)
+                for row in batch:
+                    dead_letters.append((cls, row, str(e), True))
+                return
+
+            attempt += 1
+            log.warning('%s... Retrying', e)
+            time.sleep(0.5 * 2 ** attempt)
+
+
+# SQLite has INSERT ... ON CONFLICT DO UPDATE since 3.24.
+SQLITE_UPSERT = sqlite3.sqlite_version_info >= (3, 24, 0)
+
+
+# peewee's upsert() is a REPLACE, which deletes and reinserts rows, rewriting
+# every index and resetting the columns missing from the row. Update existing
+# rows in place instead, only touching the given columns.
+def insert_on_duplicate(cls, rows):
+    sql, params = InsertQuery(cls, rows=rows).sql()
+    sql += on_duplicate_clause(cls, tuple(rows[0]))
+    cls._meta.database.execute_sql(sql, params)
+
+
+on_duplicate_clauses = {}
+
+
+# The ON DUPLICATE KEY UPDATE clause, or SQLite's ON CONFLICT DO UPDATE, for
+# rows with the given keys, built once per model and set of keys. Columns in
+# the model's Meta.upsert_coalesce keep their value when the new one is NULL.
+def on_duplicate_clause(cls, keys):
+    clause = on_duplicate_clauses.get((cls, keys))
+    if clause is None:
+        pk = primary_key_names(cls)
+        coalesce = getattr(cls._meta, 'upsert_coalesce', ())
+        quote = cls._meta.database.compiler().quote
+        new = 'VALUES(%s)' if args.db_type == 'mysql' else 'excluded.%s'
+        updates = []
+        for key in keys:
+            field = cls._meta.fields[getattr(key, 'name', key)]
+            column = quote(field.db_column)
+            if field.name in pk:
                 continue
+            if field.name in coalesce:
+                updates.append('%s = COALESCE(%s, %s)' % (column, new % column, column))
+            else:
+                updates.append('%s = %s' % (column, new % column))
+        pk_columns = [quote(cls._meta.fields[name].db_column) for name in pk]
+        if not updates:
+            # Rows of only key columns, there is nothing to update.
+            updates.append('%s = %s' % (pk_columns[0], pk_columns[0]))
+        if args.db_type == 'mysql':
+            clause = ' ON DUPLICATE KEY UPDATE ' + ', '.join(updates)
+        else:
+            clause = ' ON CONFLICT (%s) DO UPDATE SET %s' % (
+                ', '.join(pk_columns), ', '.join(updates))
+        on_duplicate_clauses[(cls, keys)] = clause
+    return clause
+
+
+# Older SQLite only has the REPLACE, which writes whole rows: fill the
+# Meta.upsert_coalesce columns a row leaves NULL from the stored row. Filled
+# rows are copies replacing the ones in rows, the queued rows may be shared.
+def fill_coalesced(cls, rows):
+    coalesce = getattr(cls._meta, 'upsert_coalesce', ())
+    pk = primary_key_names(cls)
+    if not coalesce or len(pk) != 1:
+        return
+
+    missing = [i for i, row in enumerate(rows)
+               if any(name in row and row[name] is None for name in coalesce)]
+    missing = [i for i in missing if rows[i].get(pk[0]) is not None]
+    if not missing:
+        return
+
+    key = cls._meta.fields[pk[0]]
+    query = (cls
+             .select(key, *[cls._meta.fields[name] for name in coalesce])
+             .where(key << [rows[i][pk[0]] for i in missing])
+             .dicts())
+    stored = dict((old[pk[0]], old) for old in query)
+    for i in missing:
+        old = stored.get(rows[i][pk[0]], {})
+        kept = dict((name, old[name]) for name in coalesce
+                    if name in rows[i] and rows[i][name] is None and old.get(name) is not None)
+        if kept:
+            rows[i] = dict(rows[i], **kept)
+
+
+# Try the rows that failed on database errors once more, e.g. after the
+# database came back. Rows failing again go back to dead_letters.
+def replay_dead_letters():
+    replay = OrderedDict()
+    for _ in range(len(dead_letters)):
+        try:
+            letter = dead_letters.popleft()
+        except IndexError:
+            break
+        cls, row, error, recoverable = letter
+        if recoverable:
+            replay.setdefault(cls, []).append(row)
+        else:
+            dead_letters.append(letter)
 
-        i += step
+    for cls, rows in replay.iteritems():
+        log.info('Retrying %d %s rows that failed before.', len(rows), cls.__name__)
+        if commit_updates([(cls, rows)], retries=0):
+            updates_committed(cls, rows)
 
 
 def create_tables(db):
     db.connect()
     verify_database_schema(db)
     db.create_tables([Pokemon, Pokestop, Gym, ScannedLocation, GymDetails, GymMember, GymPokemon,
-                      Trainer, MainWorker, WorkerStatus, SpawnPoint, ScanSpawnPoint, SpawnpointDetectionData], safe=True)
+                      Trainer, MainWorker, WorkerStatus, SpawnPoint, ScanSpawnPoint, SpawnpointDetectionData,
+                      PokemonSeenHourly, PokemonSeenDaily, PokemonLastSeen, PokemonAppearance], safe=True)
     db.close()
 
 
 def drop_tables(db):
     db.connect()
     db.drop_tables([Pokemon, Pokestop, Gym, ScannedLocation, Versions, GymDetails, GymMember, GymPokemon,
-                    Trainer, MainWorker, WorkerStatus, SpawnPoint, ScanSpawnPoint, SpawnpointDetectionData, Versions], safe=True)
+                    Trainer, MainWorker, WorkerStatus, SpawnPoint, ScanSpawnPoint, SpawnpointDetectionData,
+                    PokemonSeenHourly, PokemonSeenDaily, PokemonLastSeen, PokemonAppearance, Versions], safe=True)
     db.close()
 
 
@@ -1990,6 +3085,7 @@ def verify_database_schema(db):
             database_migrate(db, 0)
         else:
             InsertQuery(Versions, {Versions.key: 'schema_version', Versions.val: db_schema_version}).execute()
+            InsertQuery(Versions, {Versions.key: 'seen_stats_until', Versions.val: 0}).execute()
 
     else:
         db_ver = Versions.get(Versions.key == 'schema_version').val
@@ -2080,3 +3176,49 @@ def database_migrate(db, old_ver):
         migrate(
             migrator.add_column('workerstatus', 'captchas', IntegerField(default=0))
         )
+
+    if old_ver < 12:
+        # Filled in by seen_stats_loop, starting from the oldest sighting.
+        db.create_tables([PokemonSeenHourly, PokemonSeenDaily, PokemonLastSeen], safe=True)
+        InsertQuery(Versions, {Versions.key: 'seen_stats_until', Versions.val: 0}).execute()
+
+    if old_ver < 13:
+        db.create_tables([PokemonAppearance], safe=True)
+
+    if old_ver < 14:
+        # The viewport indexes also carry the column the map's incremental
+        # queries filter on, so rows outside the time window are skipped in
+        # the index instead of being read.
+        for table, column in (('pokemon', 'disappear_time'),
+                              ('pokestop', 'last_updated'),
+                              ('gym', 'last_scanned'),
+                              ('scannedlocation', 'last_modified'),
+                              ('spawnpoint', 'last_scanned')):
+            migrate(
+                migrator.add_index(table, ('latitude', 'longitude', column), False),
+                migrator.drop_index(table, '{}_latitude_longitude'.format(table))
+            )
+
+    if old_ver < 15:
+        # Appearances are counted per day instead of kept per sighting. The
+        # sightings already past the seen statistics watermark are counted
+        # again from the pokemon table, a day at a time.
+        db.drop_tables([PokemonAppearance], safe=True)
+        db.create_tables([PokemonAppearance], safe=True)
+        watermark = datetime.utcfromtimestamp(get_seen_watermark())
+        first = Pokemon.select(fn.MIN(Pokemon.disappear_time)).scalar(convert=True)
+        day = day_bucket(first) if first else watermark
+        while day < watermark:
+            query = (Pokemon
+                     .select(Pokemon.pokemon_id,
+                             Pokemon.spawnpoint_id,
+                             Pokemon.disappear_time,
+                             Pokemon.latitude,
+                             Pokemon.longitude)
+                     .where((Pokemon.disappear_time >= day) &
+                            (Pokemon.disappear_time < day + timedelta(days=1)) &
+                            (Pokemon.disappear_time <= watermark))
+                     .dicts())
+            with db.atomic():
+                add_appearance_counts(count_sightings(query)[3])
+            day += timedelta(days=1)
@@ -0,0 +1,53 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+
+def hour_bucket(d):
+    return d.replace(minute=0, second=0, microsecond=0)
+
+
+def day_bucket(d):
+    return d.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+# Counts Pokemon sightings per species into hourly and daily buckets of their
+# disappear time, and per species and spawnpoint into daily buckets, plus the
+# latest sighting of each species. Returns (hourly, daily, last_seen,
+# appearances), to be added to the rollup tables.
+def count_sightings(pokemons):
+    hourly = {}  # (pokemon_id, hour) -> count
+    daily = {}  # (pokemon_id, day) -> count
+    last_seen = {}  # pokemon_id -> latest sighting
+    appearances = {}  # (pokemon_id, spawnpoint_id, day) -> row with a count
+    for p in pokemons:
+        pokemon_id = p['pokemon_id']
+        hour = hour_bucket(p['disappear_time'])
+        key = (pokemon_id, hour)
+        hourly[key] = hourly.get(key, 0) + 1
+        day = day_bucket(hour)
+        key = (pokemon_id, day)
+        daily[key] = daily.get(key, 0) + 1
+
+        key = (pokemon_id, p['spawnpoint_id'], day)
+        appearance = appearances.get(key)
+        if appearance is None:
+            appearance = appearances[key] = {
+                'pokemon_id': pokemon_id,
+                'spawnpoint_id': p['spawnpoint_id'],
+                'day': day,
+                'latitude': p['latitude'],
+                'longitude': p['longitude'],
+                'count': 0,
+            }
+        appearance['count'] += 1
+
+        last = last_seen.get(pokemon_id)
+        if last is None or last['disappear_time'] < p['disappear_time']:
+            last_seen[pokemon_id] = {
+                'pokemon_id': pokemon_id,
+                'disappear_time': p['disappear_time'],
+                'latitude': p['latitude'],
+                'longitude': p['longitude'],
+            }
+
+    return hourly, daily, last_seen, appearances
@@ -50,7 +50,7 @@ from queue import Empty
 from operator import itemgetter
 from datetime import datetime, timedelta
 from .transform import get_new_coords
-from .models import hex_bounds, Pokemon, SpawnPoint, ScannedLocation, ScanSpawnPoint
+from .models import hex_bounds, SpawnPoint, ScannedLocation, ScanSpawnPoint, scan_state
 from .utils import now, cur_sec, cellid, date_secs, equi_rect_distance
 
 log = logging.getLogger(__name__)
@@ -78,6 +78,8 @@ class BaseScheduler(object):
     def location_changed(self, scan_location, dbq):
         self.scan_location = scan_location
         self.empty_queues()
+        # A step of margin keeps the spawnpoints linked to the outer steps.
+        scan_state.set_area(self, hex_bounds(scan_location, self.args.step_limit + 1))
 
     # scanning_pause function is called when scanning is paused from the UI.
     # The default function will empty all the queues.
@@ -160,8 +162,7 @@ class HexSearch(BaseScheduler):
 
     # On location change, empty the current queue and the locations list
     def location_changed(self, scan_location, dbq):
-        self.scan_location = scan_location
-        self.empty_queues()
+        super(HexSearch, self).location_changed(scan_location, dbq)
         self.locations = False
 
     # Generates the list of locations to scan.
@@ -296,7 +297,7 @@ class HexSearchSpawnpoint(HexSearch):
     # Extend the generate_locations function to remove locations with no spawnpoints.
     def _generate_locations(self):
         n, e, s, w = hex_bounds(self.scan_location, self.step_limit)
-        spawnpoints = set((d['latitude'], d['longitude']) for d in Pokemon.get_spawnpoints(s, w, n, e))
+        spawnpoints = set((d['latitude'], d['longitude']) for d in SpawnPoint.get_spawnpoints(s, w, n, e))
 
         if len(spawnpoints) == 0:
             log.warning('No spawnpoints found in the specified area!  (Did you forget to run a normal scan in this area first?)')
@@ -349,7 +350,7 @@ class SpawnScan(BaseScheduler):
         # No locations yet? Try the database!
         if not self.locations:
             log.debug('Loading spawn points from database')
-            self.locations = Pokemon.get_spawnpoints_in_hex(self.scan_location, self.args.step_limit)
+            self.locations = SpawnPoint.get_spawnpoints_in_hex(self.scan_location, self.args.step_limit)
 
         # Well shit...
         # if not self.locations:
@@ -497,12 +498,16 @@ class SpeedScan(HexSearch):
 
             initial[cell] = all_scans[cell] if cell in all_scans.keys() else ScannedLocation.new_loc(e[1])
 
+        # Load the hex into the scan state store once; rows it already holds
+        # are newer than the db.
+        initial = scan_state.add_locations(initial)
+        ScannedLocation.load_links(scans.keys())
         self.scans = scans
         db_update_queue.put((ScannedLocation, initial))
         log.info('%d steps created', len(scans))
         self.band_spacing = int(10 * 60 / len(scans))
         self.band_status()
-        spawnpoints = SpawnPoint.select_in_hex(self.scan_location, self.args.step_limit)
+        spawnpoints = scan_state.add_spawnpoints(SpawnPoint.select_in_hex(self.scan_location, self.args.step_limit))
         if not spawnpoints:
             log.info('No spawnpoints in hex found in SpawnPoint table. Doing initial scan.')
         log.info('Found %d spawn points within hex', len(spawnpoints))
@@ -515,6 +520,7 @@ class SpeedScan(HexSearch):
         ScannedLocation.link_spawn_points(scans, initial, spawnpoints, self.step_distance, scan_spawn_point)
         if len(scan_spawn_point):
             log.info('%d relations found between the spawn points and steps', len(scan_spawn_point))
+            scan_state.add_links(scan_spawn_point.values())
             db_update_queue.put((ScanSpawnPoint, scan_spawn_point))
         else:
             log.info('Spawn points assigned')
@@ -672,7 +678,7 @@ class SpeedScan(HexSearch):
                 found_percent = 100.0
                 good_percent = 100.0
                 spawns_reached = 100.0
-                spawnpoints = SpawnPoint.select_in_hex(self.scan_location, self.args.step_limit)
+                spawnpoints = scan_state.add_spawnpoints(SpawnPoint.select_in_hex(self.scan_location, self.args.step_limit))
                 for sp in spawnpoints:
                     if sp['missed_count'] > 5:
                         continue
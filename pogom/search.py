@@ -37,7 +37,8 @@ from pgoapi.utilities import f2i
 from pgoapi import utilities as util
 from pgoapi.exceptions import AuthException
 
-from .models import parse_map, GymDetails, parse_gyms, MainWorker, WorkerStatus
+from .models import parse_map, GymDetails, parse_gyms, MainWorker, WorkerStatus, Pokemon
+from .encounter import EncounterQueue
 from .fakePogoApi import FakePogoApi
 from .utils import now
 from .transform import get_new_coords
@@ -328,6 +329,18 @@ def search_overseer_thread(args, new_location_queue, pause_bit, heartb, db_updat
         t.daemon = True
         t.start()
 
+    # Encounters are made by their own threads, through the api of the
+    # account that found the Pokemon.
+    encounter_queue = EncounterQueue(args.encounter_delay)
+    if args.encounter:
+        log.info('Starting encounter worker threads')
+        for i in range(args.encounter_threads):
+            t = Thread(target=encounter_worker_thread,
+                       name='encounter-worker-{}'.format(i),
+                       args=(args, encounter_queue, db_updates_queue, wh_queue))
+            t.daemon = True
+            t.start()
+
     # Create specified number of search_worker_thread.
     log.info('Starting search worker threads')
     for i in range(0, args.workers):
@@ -363,7 +376,7 @@ def search_overseer_thread(args, new_location_queue, pause_bit, heartb, db_updat
                    name='search-worker-{}'.format(i),
                    args=(args, account_queue, account_failures, search_items_queue, pause_bit,
                          threadStatus[workerId],
-                         db_updates_queue, wh_queue, scheduler))
+                         db_updates_queue, wh_queue, scheduler, encounter_queue))
         t.daemon = True
         t.start()
 
@@ -480,14 +493,20 @@ def generate_hive_locations(current_location, step_distance, step_limit, hive_co
     return results
 
 
-def search_worker_thread(args, account_queue, account_failures, search_items_queue, pause_bit, status, dbq, whq, scheduler):
+def search_worker_thread(args, account_queue, account_failures, search_items_queue, pause_bit, status, dbq, whq, scheduler, encounter_queue):
 
     log.debug('Search worker thread starting')
 
+    api = None
+
     # The outer forever loop restarts only when the inner one is intentionally exited - which should only be done when the worker is failing too often, and probably banned.
     # This reinitializes the API and grabs a new account from the queue.
     while True:
         try:
+            # The account's encounters won't be made any more.
+            if api is not None:
+                encounter_queue.retire(api)
+
             status['starttime'] = now()
 
             # Get an account.
@@ -614,23 +633,28 @@ def search_worker_thread(args, account_queue, account_failures, search_items_que
                 status['message'] = messages['search']
                 log.debug(status['message'])
 
-                # Let the api know where we intend to be for this loop
-                # doing this before check_login so it does not also have to be done there
-                # when the auth token is refreshed
-                api.set_position(*step_location)
+                # Let the encounters of the last location finish first.
+                encounter_queue.wait(api, args.scan_delay)
 
-                # Ok, let's get started -- check our login status
-                status['message'] = 'Logging in...'
-                check_login(args, account, api, step_location, status['proxy_url'])
+                # The encounter workers share the api, one request at a time.
+                with encounter_queue.lock(api):
+                    # Let the api know where we intend to be for this loop
+                    # doing this before check_login so it does not also have to be done there
+                    # when the auth token is refreshed
+                    api.set_position(*step_location)
 
-                # putting this message after the check_login so the messages aren't out of order
-                status['message'] = messages['search']
-                log.info(status['message'])
+                    # Ok, let's get started -- check our login status
+                    status['message'] = 'Logging in...'
+                    check_login(args, account, api, step_location, status['proxy_url'])
 
-                # Make the actual request. (finally!)
-                scan_date = datetime.utcnow()
-                response_dict = map_request(api, step_location, args.jitter)
-                status['last_scan_date'] = datetime.utcnow()
+                    # putting this message after the check_login so the messages aren't out of order
+                    status['message'] = messages['search']
+                    log.info(status['message'])
+
+                    # Make the actual request. (finally!)
+                    scan_date = datetime.utcnow()
+                    response_dict = map_request(api, step_location, args.jitter)
+                    status['last_scan_date'] = datetime.utcnow()
 
                 # Record the time and place the worker made the request at
                 status['latitude'] = step_location[0]
@@ -663,13 +687,15 @@ def search_worker_thread(args, account_queue, account_failures, search_items_que
                             else:
                                 status['message'] = 'Retrieved captcha token, attempting to verify challenge for {}'.format(account['username'])
                                 log.info(status['message'])
-                                response = api.verify_challenge(token=captcha_token)
+                                with encounter_queue.lock(api):
+                                    response = api.verify_challenge(token=captcha_token)
                                 if 'success' in response['responses']['VERIFY_CHALLENGE']:
                                     status['message'] = "Account {} successfully uncaptcha'd".format(account['username'])
                                     log.info(status['message'])
                                     scan_date = datetime.utcnow()
                                     # Make another request for the same coordinate since the previous one was captcha'd
-                                    response_dict = map_request(api, step_location, args.jitter)
+                                    with encounter_queue.lock(api):
+                                        response_dict = map_request(api, step_location, args.jitter)
                                     status['last_scan_date'] = datetime.utcnow()
                                 else:
                                     status['message'] = "Account {} failed verifyChallenge, putting away account for now".format(account['username'])
@@ -677,7 +703,7 @@ def search_worker_thread(args, account_queue, account_failures, search_items_que
                                     account_failures.append({'account': account, 'last_fail_time': now(), 'reason': 'catpcha failed to verify'})
                                     break
 
-                    parsed = parse_map(args, response_dict, step_location, dbq, whq, api, scan_date)
+                    parsed = parse_map(args, response_dict, step_location, dbq, whq, api, scan_date, encounter_queue)
                     scheduler.task_done(status, parsed)
                     if parsed['count'] > 0:
                         status['success'] += 1
@@ -731,7 +757,8 @@ def search_worker_thread(args, account_queue, account_failures, search_items_que
                         for gym in gyms_to_update.values():
                             status['message'] = 'Getting details for gym {} of {} for location {:6f},{:6f}...'.format(current_gym, len(gyms_to_update), step_location[0], step_location[1])
                             time.sleep(random.random() + 2)
-                            response = gym_request(api, step_location, gym)
+                            with encounter_queue.lock(api):
+                                response = gym_request(api, step_location, gym)
 
                             # make sure the gym was in range. (sometimes the API gets cranky about gyms that are ALMOST 1km away)
                             if response['responses']['GET_GYM_DETAILS']['result'] == 2:
@@ -757,6 +784,8 @@ def search_worker_thread(args, account_queue, account_failures, search_items_que
         # Catch any process exceptions, log them, and continue the thread.
         except Exception as e:
             log.error('Exception in search_worker under account {} Exception message: {}'.format(account['username'], e))
+            if api is not None:
+                encounter_queue.retire(api)
             status['message'] = 'Exception in search_worker using account {}. Restarting with fresh account. See logs for details.'.format(account['username'])
             traceback.print_exc(file=sys.stdout)
             account_failures.append({'account': account, 'last_fail_time': now(), 'reason': 'exception'})
@@ -825,6 +854,69 @@ def map_request(api, position, jitter=False):
         return False
 
 
+def encounter_request(api, position, encounter_id, spawn_point_id):
+    log.debug('Encountering pokemon %s at spawnpoint %s', encounter_id, spawn_point_id)
+    req = api.create_request()
+    x = req.encounter(encounter_id=encounter_id,
+                      spawn_point_id=spawn_point_id,
+                      player_latitude=position[0],
+                      player_longitude=position[1])
+    x = req.check_challenge()
+    x = req.get_hatched_eggs()
+    x = req.get_inventory()
+    x = req.check_awarded_badges()
+    x = req.download_settings()
+    x = req.get_buddy_walked()
+    x = req.call()
+    return x
+
+
+# Make the encounters queued by parse_map, and merge the IVs and moves into
+# the Pokemon rows and webhooks already sent out.
+def encounter_worker_thread(args, encounter_queue, dbq, whq):
+    log.debug('Encounter worker thread starting')
+
+    while True:
+        job = encounter_queue.get()
+        try:
+            pokemon = job['pokemon']
+            if pokemon['disappear_time'] <= datetime.utcnow():
+                log.debug('Pokemon %s despawned before it could be encountered', pokemon['encounter_id'])
+                continue
+
+            time.sleep(encounter_queue.reserve(job['api']))
+            with encounter_queue.lock(job['api']):
+                if not encounter_queue.current(job):
+                    log.debug('Account moved on before pokemon %s could be encountered', pokemon['encounter_id'])
+                    continue
+                response = encounter_request(job['api'], job['position'], job['encounter_id'], job['spawn_point_id'])
+
+            if 'wild_pokemon' not in response['responses']['ENCOUNTER']:
+                log.debug('Encounter of pokemon %s returned no data', pokemon['encounter_id'])
+                continue
+
+            pokemon_info = response['responses']['ENCOUNTER']['wild_pokemon']['pokemon_data']
+            pokemon = dict(pokemon)
+            pokemon.update({
+                'individual_attack': pokemon_info.get('individual_attack', 0),
+                'individual_defense': pokemon_info.get('individual_defense', 0),
+                'individual_stamina': pokemon_info.get('individual_stamina', 0),
+                'move_1': pokemon_info['move_1'],
+                'move_2': pokemon_info['move_2'],
+            })
+            dbq.put((Pokemon, {pokemon['encounter_id']: pokemon}))
+
+            if args.webhooks:
+                wh_poke = pokemon.copy()
+                wh_poke.update(job['webhook'])
+                whq.put(('pokemon', wh_poke))
+
+        except Exception as e:
+            log.warning('Exception while encountering pokemon: %s', e)
+        finally:
+            encounter_queue.done(job)
+
+
 def gym_request(api, position, gym):
     try:
         log.debug('Getting details for gym @ %f/%f (%fkm away)', gym['latitude'], gym['longitude'], calc_distance(position, [gym['latitude'], gym['longitude']]))
@@ -0,0 +1,321 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import heapq
+import itertools
+import logging
+import math
+import threading
+
+from datetime import datetime
+from s2sphere import CellId, LatLng
+
+from .utils import in_radius
+
+# Optional, filters large result sets at once when installed.
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+log = logging.getLogger(__name__)
+
+# Below this many rows a plain loop is faster than building arrays.
+VECTORIZE_MIN_ROWS = 256
+
+# Meters per radian of great circle distance.
+EARTH_RADIUS = 6366468.241830914
+
+
+# Buckets points into a fixed lat/lng grid, so a viewport lookup only has to
+# look at the cells overlapping the requested box instead of every point.
+class GridIndex(object):
+
+    def __init__(self, cell_size=0.01):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.items = {}
+
+    def _cell(self, latitude, longitude):
+        return (int(math.floor(latitude / self.cell_size)),
+                int(math.floor(longitude / self.cell_size)))
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def get(self, key):
+        entry = self.items.get(key)
+        return entry[1] if entry else None
+
+    def add(self, key, latitude, longitude, value):
+        self.remove(key)
+        cell = self._cell(latitude, longitude)
+        self.cells.setdefault(cell, {})[key] = value
+        self.items[key] = (cell, value)
+
+    def remove(self, key):
+        entry = self.items.pop(key, None)
+        if entry is None:
+            return None
+
+        bucket = self.cells[entry[0]]
+        del bucket[key]
+        if not bucket:
+            del self.cells[entry[0]]
+
+        return entry[1]
+
+    def values(self):
+        return [entry[1] for entry in self.items.itervalues()]
+
+    # Return every value stored in a cell overlapping the box. Values close to
+    # the edges still need to be checked against the exact bounds.
+    def candidates(self, swLat, swLng, neLat, neLng):
+        sw = self._cell(swLat, swLng)
+        ne = self._cell(neLat, neLng)
+        results = []
+
+        if (ne[0] - sw[0] + 1) * (ne[1] - sw[1] + 1) >= len(self.cells):
+            # Zoomed far out, walking the populated cells is cheaper.
+            for cell, bucket in self.cells.iteritems():
+                if sw[0] <= cell[0] <= ne[0] and sw[1] <= cell[1] <= ne[1]:
+                    results.extend(bucket.itervalues())
+        else:
+            for x in xrange(sw[0], ne[0] + 1):
+                for y in xrange(sw[1], ne[1] + 1):
+                    bucket = self.cells.get((x, y))
+                    if bucket:
+                        results.extend(bucket.itervalues())
+
+        return results
+
+
+def in_bounds(latitude, longitude, swLat, swLng, neLat, neLng):
+    return swLat <= latitude <= neLat and swLng <= longitude <= neLng
+
+
+def coordinates(rows):
+    latitudes = np.fromiter((r['latitude'] for r in rows), dtype=float, count=len(rows))
+    longitudes = np.fromiter((r['longitude'] for r in rows), dtype=float, count=len(rows))
+    return latitudes, longitudes
+
+
+# The rows (dicts with latitude and longitude) within the box.
+def within(rows, swLat, swLng, neLat, neLng):
+    if np is None or len(rows) < VECTORIZE_MIN_ROWS:
+        return [r for r in rows
+                if in_bounds(r['latitude'], r['longitude'], swLat, swLng, neLat, neLng)]
+
+    latitudes, longitudes = coordinates(rows)
+    mask = (latitudes >= swLat) & (latitudes <= neLat) & (longitudes >= swLng) & (longitudes <= neLng)
+    return [rows[i] for i in np.flatnonzero(mask)]
+
+
+# Great circle distances in radians from a point to each row, using the same
+# formula as s2sphere's LatLng.get_distance.
+def angular_distances(latitude, longitude, rows):
+    lat = math.radians(latitude)
+    lng = math.radians(longitude)
+
+    if np is None or len(rows) < VECTORIZE_MIN_ROWS:
+        distances = []
+        for r in rows:
+            r_lat = math.radians(r['latitude'])
+            dlat = math.sin(0.5 * (r_lat - lat))
+            dlng = math.sin(0.5 * (math.radians(r['longitude']) - lng))
+            x = dlat * dlat + dlng * dlng * math.cos(lat) * math.cos(r_lat)
+            distances.append(2 * math.asin(math.sqrt(min(1.0, x))))
+        return distances
+
+    latitudes, longitudes = coordinates(rows)
+    latitudes = np.radians(latitudes)
+    dlat = np.sin(0.5 * (latitudes - lat))
+    dlng = np.sin(0.5 * (np.radians(longitudes) - lng))
+    x = dlat * dlat + dlng * dlng * math.cos(lat) * np.cos(latitudes)
+    return (2 * np.arcsin(np.sqrt(np.minimum(1.0, x)))).tolist()
+
+
+# The (swLat, swLng, neLat, neLng) box holding everything within radius meters
+# of a point.
+def box_around(latitude, longitude, radius):
+    dlat = math.degrees(radius / EARTH_RADIUS)
+    cos_lat = math.cos(math.radians(min(abs(latitude) + dlat, 90.0)))
+    dlng = 180.0 if cos_lat < 1e-6 else min(math.degrees(radius / EARTH_RADIUS) / cos_lat, 180.0)
+    return latitude - dlat, longitude - dlng, latitude + dlat, longitude + dlng
+
+
+# The rows closest to a point as (meters, row), nearest first. Rows further
+# than radius are left out, and at most limit are returned (0 for no limit).
+def nearest(rows, latitude, longitude, radius=0, limit=0):
+    found = [(d * EARTH_RADIUS, r) for d, r in zip(angular_distances(latitude, longitude, rows), rows)]
+    if radius:
+        found = [f for f in found if f[0] <= radius]
+
+    if limit:
+        return heapq.nsmallest(limit, found, key=lambda f: f[0])
+    return sorted(found, key=lambda f: f[0])
+
+
+# In-memory copy of the Pokemon that haven't despawned yet, so the map can be
+# answered without running a bounding box scan over the pokemon table on every
+# poll. Records are plain dicts shaped like Pokemon.select().dicts() rows and
+# are replaced, never mutated, so they can be read without holding the lock.
+#
+# Polls for what changed since their timestamp are answered by when records
+# changed here, not by their last_modified. Rows written by other instances
+# only arrive with the next sync, when a poll may already have moved its
+# timestamp past their last_modified.
+class ActivePokemonIndex(object):
+
+    def __init__(self, cell_size=0.01):
+        self.grid = GridIndex(cell_size)
+        self.expiry = []  # heap of (disappear_time, encounter_id)
+        self.changed = {}  # encounter_id -> when its record last changed here
+        self.lock = threading.Lock()
+        self.ready = False
+        # Called with the list of despawned records, after the lock is
+        # released.
+        self.on_expire = None
+
+    def __len__(self):
+        return len(self.grid)
+
+    # Add or refresh Pokemon dicts (as pushed to the db update queue).
+    # Returns the encounter ids that were not in the index before.
+    def upsert(self, pokemons, now=None):
+        now = now or datetime.utcnow()
+        new = []
+
+        with self.lock:
+            for p in pokemons:
+                if p['disappear_time'] <= now:
+                    continue
+
+                key = p['encounter_id']
+                if key not in self.grid:
+                    new.append(key)
+
+                record = dict(p)
+                record.setdefault('last_modified', now)
+                if self.grid.get(key) != record:
+                    self.changed[key] = now
+                self.grid.add(key, p['latitude'], p['longitude'], record)
+                heapq.heappush(self.expiry, (p['disappear_time'], key))
+
+            expired = self._purge(now)
+
+        self._expired(expired)
+        return new
+
+    # Drop everything that despawned, returning the dropped records. Must be
+    # called with the lock held.
+    def _purge(self, now):
+        expired = []
+        while self.expiry and self.expiry[0][0] <= now:
+            disappear_time, key = heapq.heappop(self.expiry)
+            record = self.grid.get(key)
+            # Records refreshed with a later despawn have their own heap entry.
+            if record is not None and record['disappear_time'] <= now:
+                expired.append(self.grid.remove(key))
+                self.changed.pop(key, None)
+
+        return expired
+
+    # Hand the records dropped by _purge to on_expire, without the lock, so
+    # fanning them out doesn't hold up lookups.
+    def _expired(self, expired):
+        if expired and self.on_expire:
+            self.on_expire(expired)
+
+    # Return copies of the active Pokemon matching the filters, mirroring the
+    # where clauses used by Pokemon.get_active and Pokemon.get_active_by_id.
+    # Given both since and exclude, returns the Pokemon matching either.
+    def find(self, swLat=None, swLng=None, neLat=None, neLng=None,
+             since=None, exclude=None, pokemon_ids=None):
+        now = datetime.utcnow()
+        bounded = swLat is not None
+
+        if bounded:
+            swLat, swLng, neLat, neLng = float(swLat), float(swLng), float(neLat), float(neLng)
+        if exclude:
+            exclude = [float(x) for x in exclude]
+        if pokemon_ids is not None:
+            pokemon_ids = set(pokemon_ids)
+
+        with self.lock:
+            expired = self._purge(now)
+            if bounded:
+                candidates = self.grid.candidates(swLat, swLng, neLat, neLng)
+            else:
+                candidates = self.grid.values()
+
+        self._expired(expired)
+
+        if bounded:
+            candidates = within(candidates, swLat, swLng, neLat, neLng)
+
+        results = []
+        for p in candidates:
+            if p['disappear_time'] <= now:
+                continue
+            if pokemon_ids is not None and p['pokemon_id'] not in pokemon_ids:
+                continue
+            if since is not None:
+                changed = self.changed.get(p['encounter_id'])
+                changed = changed is not None and changed > since
+            if since is not None and exclude:
+                # A viewport diff, modified or newly uncovered.
+                if not changed and in_bounds(p['latitude'], p['longitude'], *exclude):
+                    continue
+            elif since is not None:
+                if not changed:
+                    continue
+            elif exclude and in_bounds(p['latitude'], p['longitude'], *exclude):
+                continue
+            results.append(dict(p))
+
+        return results
+
+
+# Which S2 cells have forts in them, to tell quickly whether any gym or
+# pokestop is near a location. Cells are level 12, whose edges are at least
+# 1.4 km long, so a cell and its neighbours hold every fort closer than that.
+class FortPresenceIndex(object):
+
+    def __init__(self, level=12):
+        self.level = level
+        self.cells = {}  # cell id -> {fort id: (latitude, longitude)}
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return sum(len(forts) for forts in self.cells.values())
+
+    def _cell(self, latitude, longitude):
+        return CellId.from_lat_lng(LatLng.from_degrees(latitude, longitude)).parent(self.level)
+
+    # Add forts, given as (fort_id, latitude, longitude).
+    def add(self, forts):
+        with self.lock:
+            for fort_id, latitude, longitude in forts:
+                cell = self._cell(latitude, longitude).id()
+                self.cells.setdefault(cell, {})[fort_id] = (latitude, longitude)
+
+    # Fill the index with every known fort, the first time it is needed.
+    def load(self, forts):
+        self.add(forts)
+        self.loaded = True
+        log.info('Fort presence index loaded, %d forts.', len(self))
+
+    # Whether any fort is within distance km of the location.
+    def any_within(self, latitude, longitude, distance):
+        cell = self._cell(latitude, longitude)
+        for c in itertools.chain([cell], cell.get_all_neighbors(self.level)):
+            for location in self.cells.get(c.id(), {}).values():
+                if in_radius(location, (latitude, longitude), distance):
+                    return True
+
+        return False
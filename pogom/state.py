@@ -0,0 +1,136 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import threading
+
+
+# Process-local copy of the spawnpoints, scanned locations and the links
+# between them, which the scan loop and the speed scan scheduler read on every
+# scan. Rows are loaded from the database the first time they are needed and
+# from then on only change here, so scans neither wait on reads nor race the
+# asynchronous writes of their own updates. Held rows are never changed:
+# parse_map updates copies and puts them back, the last put winning like the
+# last write does in the database. So they can be read and queued as they are.
+#
+# Rows are never read back from the database while held, so this process has
+# to be the only one writing the area it scans. Rows outside the areas of the
+# current scan locations are dropped when a location changes.
+class ScanStateStore(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.spawnpoints = {}  # spawnpoint id -> spawnpoint
+        self.locations = {}  # cellid -> scanned location
+        self.links = {}  # cellid -> set of spawnpoint ids
+        self.pending_links = {}  # links added before their cell was loaded
+        self.areas = {}  # owner -> (north, east, south, west)
+
+    def __len__(self):
+        return len(self.spawnpoints)
+
+    # Returns {id: spawnpoint} of the ids held here, or found by
+    # load(missing_ids), which returns them the same way.
+    def get_spawnpoints(self, ids, load):
+        found = {}
+        missing = []
+        for sp_id in ids:
+            sp = self.spawnpoints.get(sp_id)
+            if sp is None:
+                missing.append(sp_id)
+            else:
+                found[sp_id] = sp
+
+        if missing:
+            loaded = load(missing)
+            with self.lock:
+                for sp_id, sp in loaded.iteritems():
+                    found[sp_id] = self.spawnpoints.setdefault(sp_id, sp)
+
+        return found
+
+    # Hold rows read from the database, keeping the ones already held, which
+    # may be newer. Returns the held rows.
+    def add_spawnpoints(self, rows):
+        with self.lock:
+            return [self.spawnpoints.setdefault(sp['id'], sp) for sp in rows]
+
+    # Hold updated rows.
+    def put_spawnpoints(self, rows):
+        with self.lock:
+            for sp in rows:
+                self.spawnpoints[sp['id']] = sp
+
+    # Returns the scanned location of cell, from load() if not held yet.
+    def get_location(self, cell, load):
+        scan_loc = self.locations.get(cell)
+        if scan_loc is None:
+            scan_loc = load()
+            with self.lock:
+                scan_loc = self.locations.setdefault(cell, scan_loc)
+
+        return scan_loc
+
+    # Same as add_spawnpoints, for {key: scanned location}.
+    def add_locations(self, rows):
+        with self.lock:
+            return dict((key, self.locations.setdefault(scan_loc['cellid'], scan_loc))
+                        for key, scan_loc in rows.iteritems())
+
+    def put_location(self, scan_loc):
+        with self.lock:
+            self.locations[scan_loc['cellid']] = scan_loc
+
+    # Returns the ids of the spawnpoints linked to cell, from load() if not
+    # held yet.
+    def get_links(self, cell, load):
+        links = self.links.get(cell)
+        if links is None:
+            loaded = load()
+            with self.lock:
+                links = self.links.get(cell)
+                if links is None:
+                    links = set(loaded) | self.pending_links.pop(cell, set())
+                    self.links[cell] = links
+
+        with self.lock:
+            return sorted(links)
+
+    # Hold the links of cells read from the database, given as
+    # {cellid: spawnpoint ids}, for the cells not held yet.
+    def load_links(self, links):
+        with self.lock:
+            for cell, sp_ids in links.iteritems():
+                if cell not in self.links:
+                    self.links[cell] = set(sp_ids) | self.pending_links.pop(cell, set())
+
+    # Set the area owner, usually a scheduler, scans now, as a (north, east,
+    # south, west) box, and drop the rows outside every owner's area along
+    # with the links of the dropped locations. Dropped rows load again when
+    # needed.
+    def set_area(self, owner, bounds):
+        with self.lock:
+            self.areas[owner] = bounds
+            areas = self.areas.values()
+
+            def inside(row):
+                return any(s <= row['latitude'] <= n and w <= row['longitude'] <= e
+                           for n, e, s, w in areas)
+
+            self.locations = dict((cell, scan_loc) for cell, scan_loc in self.locations.iteritems()
+                                  if inside(scan_loc))
+            self.spawnpoints = dict((sp_id, sp) for sp_id, sp in self.spawnpoints.iteritems()
+                                    if inside(sp))
+            self.links = dict((cell, links) for cell, links in self.links.iteritems()
+                              if cell in self.locations)
+            self.pending_links = dict((cell, links) for cell, links in self.pending_links.iteritems()
+                                      if cell in self.locations)
+
+    # Add links, given as ScanSpawnPoint rows.
+    def add_links(self, rows):
+        with self.lock:
+            for row in rows:
+                cell = row['scannedlocation']
+                links = self.links.get(cell)
+                if links is None:
+                    links = self.pending_links.setdefault(cell, set())
+                links.add(row['spawnpoint'])
@@ -0,0 +1,94 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import threading
+
+from queue import Queue, Full
+
+from .spatial import in_bounds
+
+log = logging.getLogger(__name__)
+
+
+# A client listening to /stream. Events are pre-encoded strings, so fanning
+# out a change costs a bounds check and a queue put per client.
+class Subscription(object):
+
+    def __init__(self, swLat, swLng, neLat, neLng, layers, maxsize):
+        self.bounds = (float(swLat), float(swLng), float(neLat), float(neLng))
+        self.layers = set(layers)
+        self.queue = Queue(maxsize=maxsize)
+        self.closed = False
+
+    def wants(self, layer, row):
+        if layer not in self.layers:
+            return False
+        if row.get('latitude') is None:
+            return True
+        return in_bounds(row['latitude'], row['longitude'], *self.bounds)
+
+    def close(self):
+        self.closed = True
+        try:
+            # Wake the response generator up.
+            self.queue.put_nowait(None)
+        except Full:
+            pass
+
+
+# Fans out changes committed by this instance to the /stream clients whose
+# viewport they fall in. Clients that can't keep up are dropped, they
+# reconnect and catch up through /raw_data.
+class StreamBroker(object):
+
+    def __init__(self, maxsize=500):
+        self.maxsize = maxsize
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.json_encoder = None
+
+    def __len__(self):
+        return len(self.subscribers)
+
+    def subscribe(self, swLat, swLng, neLat, neLng, layers):
+        sub = Subscription(swLat, swLng, neLat, neLng, layers, self.maxsize)
+        with self.lock:
+            self.subscribers.add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self.lock:
+            self.subscribers.discard(sub)
+        sub.closed = True
+
+    def encode(self, event, rows):
+        data = json.dumps(rows, cls=self.json_encoder, separators=(',', ':'))
+        return 'event: {}\ndata: {}\n\n'.format(event, data)
+
+    # Send rows of a layer ('pokemon', 'pokestops', 'gyms', 'scanned' or
+    # 'expired') to every client they are relevant to.
+    def publish(self, layer, rows):
+        with self.lock:
+            subscribers = list(self.subscribers)
+
+        # Encode once per client subset, most often all clients share one.
+        encoded = {}
+        for sub in subscribers:
+            if sub.closed:
+                continue
+            selected = [r for r in rows if sub.wants(layer, r)]
+            if not selected:
+                continue
+
+            key = tuple(id(r) for r in selected)
+            if key not in encoded:
+                encoded[key] = self.encode(layer, selected)
+
+            try:
+                sub.queue.put_nowait(encoded[key])
+            except Full:
+                log.debug('Dropping a stream client that fell behind.')
+                self.unsubscribe(sub)
+                sub.close()
@@ -1,6 +1,12 @@
 import math
 import geopy
 
+# Optional, converts whole result sets at once when installed.
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 a = 6378245.0
 ee = 0.00669342162296594323
 pi = 3.14159265358979324
@@ -15,34 +21,81 @@ def transform_from_wgs_to_gcj(latitude, longitude):
         rad_lat = latitude / 180.0 * pi
         magic = math.sin(rad_lat)
         magic = 1 - ee * magic * magic
-        math.sqrt_magic = math.sqrt(magic)
-        adjust_lat = (adjust_lat * 180.0) / ((a * (1 - ee)) / (magic * math.sqrt_magic) * pi)
-        adjust_lon = (adjust_lon * 180.0) / (a / math.sqrt_magic * math.cos(rad_lat) * pi)
+        sqrt_magic = math.sqrt(magic)
+        adjust_lat = (adjust_lat * 180.0) / ((a * (1 - ee)) / (magic * sqrt_magic) * pi)
+        adjust_lon = (adjust_lon * 180.0) / (a / sqrt_magic * math.cos(rad_lat) * pi)
         adjust_lat += latitude
         adjust_lon += longitude
     #  Print 'transfromed from ', wgs_loc, ' to ', adjust_loc.
     return adjust_lat, adjust_lon
 
 
+# Same as transform_from_wgs_to_gcj, for lists of coordinates.
+# Returns the lists of transformed latitudes and longitudes.
+def transform_many_from_wgs_to_gcj(latitudes, longitudes):
+    if np is None:
+        coords = [transform_from_wgs_to_gcj(lat, lng) for lat, lng in zip(latitudes, longitudes)]
+        return [c[0] for c in coords], [c[1] for c in coords]
+
+    latitude = np.asarray(latitudes, dtype=float)
+    longitude = np.asarray(longitudes, dtype=float)
+    in_china = ~((longitude < 72.004) | (longitude > 137.8347) | (latitude < 0.8293) | (latitude > 55.8271))
+
+    adjust_lat = transform_lat(longitude - 105, latitude - 35.0, np)
+    adjust_lon = transform_long(longitude - 105, latitude - 35.0, np)
+    rad_lat = latitude / 180.0 * pi
+    magic = np.sin(rad_lat)
+    magic = 1 - ee * magic * magic
+    sqrt_magic = np.sqrt(magic)
+    adjust_lat = (adjust_lat * 180.0) / ((a * (1 - ee)) / (magic * sqrt_magic) * pi)
+    adjust_lon = (adjust_lon * 180.0) / (a / sqrt_magic * np.cos(rad_lat) * pi)
+
+    return (np.where(in_china, latitude + adjust_lat, latitude).tolist(),
+            np.where(in_china, longitude + adjust_lon, longitude).tolist())
+
+
+# Transform the coordinates of row dicts in place, batch by batch.
+def transform_rows_from_wgs_to_gcj(rows, batch_size=1000):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            for row in _transform_batch(batch):
+                yield row
+            batch = []
+    for row in _transform_batch(batch):
+        yield row
+
+
+def _transform_batch(rows):
+    if rows:
+        latitudes, longitudes = transform_many_from_wgs_to_gcj(
+            [r['latitude'] for r in rows], [r['longitude'] for r in rows])
+        for row, latitude, longitude in zip(rows, latitudes, longitudes):
+            row['latitude'], row['longitude'] = latitude, longitude
+    return rows
+
+
 def is_location_out_of_china(latitude, longitude):
     if longitude < 72.004 or longitude > 137.8347 or latitude < 0.8293 or latitude > 55.8271:
         return True
     return False
 
 
-def transform_lat(x, y):
-    lat = -100.0 + 2.0 * x + 3.0 * y + 0.2 * y * y + 0.1 * x * y + 0.2 * math.sqrt(abs(x))
-    lat += (20.0 * math.sin(6.0 * x * pi) + 20.0 * math.sin(2.0 * x * pi)) * 2.0 / 3.0
-    lat += (20.0 * math.sin(y * pi) + 40.0 * math.sin(y / 3.0 * pi)) * 2.0 / 3.0
-    lat += (160.0 * math.sin(y / 12.0 * pi) + 320 * math.sin(y * pi / 30.0)) * 2.0 / 3.0
+# m is the math module for floats, or numpy for arrays.
+def transform_lat(x, y, m=math):
+    lat = -100.0 + 2.0 * x + 3.0 * y + 0.2 * y * y + 0.1 * x * y + 0.2 * m.sqrt(m.fabs(x))
+    lat += (20.0 * m.sin(6.0 * x * pi) + 20.0 * m.sin(2.0 * x * pi)) * 2.0 / 3.0
+    lat += (20.0 * m.sin(y * pi) + 40.0 * m.sin(y / 3.0 * pi)) * 2.0 / 3.0
+    lat += (160.0 * m.sin(y / 12.0 * pi) + 320 * m.sin(y * pi / 30.0)) * 2.0 / 3.0
     return lat
 
 
-def transform_long(x, y):
-    lon = 300.0 + x + 2.0 * y + 0.1 * x * x + 0.1 * x * y + 0.1 * math.sqrt(abs(x))
-    lon += (20.0 * math.sin(6.0 * x * pi) + 20.0 * math.sin(2.0 * x * pi)) * 2.0 / 3.0
-    lon += (20.0 * math.sin(x * pi) + 40.0 * math.sin(x / 3.0 * pi)) * 2.0 / 3.0
-    lon += (150.0 * math.sin(x / 12.0 * pi) + 300.0 * math.sin(x / 30.0 * pi)) * 2.0 / 3.0
+def transform_long(x, y, m=math):
+    lon = 300.0 + x + 2.0 * y + 0.1 * x * x + 0.1 * x * y + 0.1 * m.sqrt(m.fabs(x))
+    lon += (20.0 * m.sin(6.0 * x * pi) + 20.0 * m.sin(2.0 * x * pi)) * 2.0 / 3.0
+    lon += (20.0 * m.sin(x * pi) + 40.0 * m.sin(x / 3.0 * pi)) * 2.0 / 3.0
+    lon += (150.0 * m.sin(x / 12.0 * pi) + 300.0 * m.sin(x / 30.0 * pi)) * 2.0 / 3.0
     return lon
 
 
@@ -10,6 +10,7 @@ import logging
 import shutil
 import pprint
 import time
+from collections import namedtuple
 from s2sphere import CellId, LatLng
 
 from . import config
@@ -71,7 +72,7 @@ def get_args():
     parser.add_argument('-wph', '--workers-per-hive',
                         help='Only referenced when using --beehive. Sets number of workers per hive. Default value is 1', type=int, default=1)
     parser.add_argument('-l', '--location', type=parse_unicode,
-                        help='Location, can be an address or coordinates.')
+                        help='Location, can be an address or coordinates. Scanning instances keep the area they scan in memory: only one instance may scan an area of a database.')
     parser.add_argument('-alt', '--altitude',
                         help='default altitude in meter',
                         type=int, default=13)
@@ -100,8 +101,11 @@ def get_args():
                         help='PokemonGo captcha data-sitekey.',
                         default="6LeeTScTAAAAADqvhqVMhPpr_vB9D364Ia-1dSgK")
     parser.add_argument('-ed', '--encounter-delay',
-                        help='Time delay between encounter pokemon in scan threads.',
+                        help='Time delay between encounters made with the same account.',
                         type=float, default=1)
+    parser.add_argument('--encounter-threads',
+                        help='Number of threads making the encounters queued by the search workers. A search worker waits up to the scan delay for its encounters before it moves on.',
+                        type=int, default=2)
     encounter_list = parser.add_mutually_exclusive_group()
     encounter_list.add_argument('-ewht', '--encounter-whitelist', action='append', default=[],
                                 help='List of pokemon to encounter for more stats.')
@@ -184,6 +188,12 @@ def get_args():
     parser.add_argument('-pd', '--purge-data',
                         help='Clear pokemon from database this many hours after they disappear \
                         (0 to disable)', type=int, default=0)
+    parser.add_argument('--purge-detection-data',
+                        help='Clear spawnpoint sightings used to work out spawn times this many hours after they were made (0 to disable)',
+                        type=int, default=0)
+    parser.add_argument('--db-cleanup-rate',
+                        help='Most rows per second the database cleaner deletes or updates, in batches (0 for no limit)',
+                        type=int, default=2000)
     parser.add_argument('-px', '--proxy', help='Proxy url (e.g. socks5://127.0.0.1:9050)', action='append')
     parser.add_argument('-pxsc', '--proxy-skip-check', help='Disable checking of proxies before start', action='store_true', default=False)
     parser.add_argument('-pxt', '--proxy-timeout', help='Timeout settings for proxy checker in seconds ', type=int, default=5)
@@ -202,8 +212,39 @@ def get_args():
     parser.add_argument('--db-port', help='Port for the database', type=int, default=3306)
     parser.add_argument('--db-max_connections', help='Max connections (per thread) for the database.',
                         type=int, default=5)
-    parser.add_argument('--db-threads', help='Number of db threads; increase if the db queue falls behind.',
+    parser.add_argument('--db-write-connections',
+                        help='Size of the connection pool for scanning and database updates (0 to use db-max_connections per account).',
+                        type=int, default=0)
+    parser.add_argument('--db-read-connections',
+                        help='Size of the separate connection pool for web server reads (0 to share the write pool).',
+                        type=int, default=0)
+    parser.add_argument('--db-read-host',
+                        help='IP or hostname of a replica to serve web server reads from, with db-read-connections (defaults to db-host). Polls for changes since a timestamp still read from the primary, so replica lag can\'t hide rows from them.')
+    parser.add_argument('--db-read-port',
+                        help='Port of the read replica (defaults to db-port).', type=int)
+    parser.add_argument('--db-partitions',
+                        help='MySQL only: keep spawnpoint sightings in daily partitions, so purging old sightings drops whole days.',
+                        action='store_true', default=False)
+    parser.add_argument('--db-threads', help='Number of db threads (MySQL only, SQLite uses one); increase if the db queue falls behind.',
                         type=int, default=1)
+    parser.add_argument('--db-flush-interval',
+                        help='Seconds the db threads collect queued updates for before writing them, updates of the same row are merged (0 to only merge what is already queued).',
+                        type=float, default=0.5)
+    parser.add_argument('-pir', '--pokemon-index-refresh',
+                        help='Seconds between syncing the in-memory index of active Pokemon with the database (0 to disable the index and query the database directly).',
+                        type=int, default=5)
+    parser.add_argument('-rdc', '--raw-data-cache',
+                        help='Seconds a /raw_data response is shared between clients looking at the same area (0 to disable).',
+                        type=int, default=5)
+    parser.add_argument('--no-stream',
+                        help='Disable the /stream endpoint pushing map changes to clients; they fall back to polling.',
+                        action='store_true', default=False)
+    parser.add_argument('--mobile-radius',
+                        help='Meters around the location within which /mobile lists Pokemon (0 for no limit).',
+                        type=int, default=5000)
+    parser.add_argument('--mobile-limit',
+                        help='Maximum number of Pokemon listed by /mobile, nearest first (0 for no limit).',
+                        type=int, default=100)
     parser.add_argument('-wh', '--webhook', help='Define URL(s) to POST webhook information to.',
                         nargs='*', default=False, dest='webhooks')
     parser.add_argument('-gi', '--gym-info', help='Get all details about gyms (causes an additional API hit for every gym).',
@@ -472,57 +513,108 @@ def i8ln(word):
         return word
 
 
+def load_data(name):
+    file_path = os.path.join(
+        config['ROOT_PATH'],
+        config['DATA_DIR'],
+        name)
+
+    with open(file_path, 'r') as f:
+        return json.loads(f.read())
+
+
 def get_pokemon_data(pokemon_id):
     if not hasattr(get_pokemon_data, 'pokemon'):
-        file_path = os.path.join(
-            config['ROOT_PATH'],
-            config['DATA_DIR'],
-            'pokemon.min.json')
-
-        with open(file_path, 'r') as f:
-            get_pokemon_data.pokemon = json.loads(f.read())
+        get_pokemon_data.pokemon = load_data('pokemon.min.json')
     return get_pokemon_data.pokemon[str(pokemon_id)]
 
 
-def get_pokemon_name(pokemon_id):
-    return i8ln(get_pokemon_data(pokemon_id)['name'])
+def get_moves_data(move_id):
+    if not hasattr(get_moves_data, 'moves'):
+        get_moves_data.moves = load_data('moves.min.json')
+    return get_moves_data.moves[str(move_id)]
 
 
-def get_pokemon_rarity(pokemon_id):
-    return i8ln(get_pokemon_data(pokemon_id)['rarity'])
+# Localized species and move records, built once and indexed by id.
+# 'fragment' is the JSON of the species fields a map Pokemon row carries.
+Species = namedtuple('Species', ['name', 'rarity', 'types', 'fragment'])
+Move = namedtuple('Move', ['name', 'damage', 'energy', 'type'])
 
 
-def get_pokemon_types(pokemon_id):
-    pokemon_types = get_pokemon_data(pokemon_id)['types']
-    return map(lambda x: {"type": i8ln(x['type']), "color": x['color']}, pokemon_types)
+def build_table(data, make):
+    table = [None] * (max(int(k) for k in data) + 1)
+    for key, value in data.iteritems():
+        table[int(key)] = make(value)
+    return tuple(table)
 
 
-def get_moves_data(move_id):
-    if not hasattr(get_moves_data, 'moves'):
-        file_path = os.path.join(
-            config['ROOT_PATH'],
-            config['DATA_DIR'],
-            'moves.min.json')
+def make_species(data):
+    name = i8ln(data['name'])
+    rarity = i8ln(data['rarity'])
+    types = tuple({'type': i8ln(t['type']), 'color': t['color']} for t in data['types'])
+    fragment = json.dumps({'pokemon_name': name,
+                           'pokemon_rarity': rarity,
+                           'pokemon_types': types},
+                          separators=(',', ':'))[1:-1]
+    return Species(name, rarity, types, fragment)
 
-        with open(file_path, 'r') as f:
-            get_moves_data.moves = json.loads(f.read())
-    return get_moves_data.moves[str(move_id)]
+
+def make_move(data):
+    return Move(i8ln(data['name']), i8ln(data['damage']),
+                i8ln(data['energy']), i8ln(data['type']))
+
+
+# Build both tables, e.g. before serving so no request pays for it. Built on
+# first use otherwise.
+def build_species_tables():
+    get_species.table = build_table(load_data('pokemon.min.json'), make_species)
+    get_move.table = build_table(load_data('moves.min.json'), make_move)
+
+
+def get_species(pokemon_id):
+    if not hasattr(get_species, 'table'):
+        build_species_tables()
+    species = get_species.table[int(pokemon_id)]
+    if species is None:
+        raise KeyError(pokemon_id)
+    return species
+
+
+def get_move(move_id):
+    if not hasattr(get_move, 'table'):
+        build_species_tables()
+    move = get_move.table[int(move_id)]
+    if move is None:
+        raise KeyError(move_id)
+    return move
+
+
+def get_pokemon_name(pokemon_id):
+    return get_species(pokemon_id).name
+
+
+def get_pokemon_rarity(pokemon_id):
+    return get_species(pokemon_id).rarity
+
+
+def get_pokemon_types(pokemon_id):
+    return list(get_species(pokemon_id).types)
 
 
 def get_move_name(move_id):
-    return i8ln(get_moves_data(move_id)['name'])
+    return get_move(move_id).name
 
 
 def get_move_damage(move_id):
-    return i8ln(get_moves_data(move_id)['damage'])
+    return get_move(move_id).damage
 
 
 def get_move_energy(move_id):
-    return i8ln(get_moves_data(move_id)['energy'])
+    return get_move(move_id).energy
 
 
 def get_move_type(move_id):
-    return i8ln(get_moves_data(move_id)['type'])
+    return get_move(move_id).type
 
 
 class Timer():
@@ -20,10 +20,11 @@ from flask_cache_bust import init_cache_busting
 
 from pogom import config
 from pogom.app import Pogom
-from pogom.utils import get_args, now
+from pogom.utils import get_args, now, build_species_tables
 
 from pogom.search import search_overseer_thread
-from pogom.models import init_database, create_tables, drop_tables, Pokemon, db_updater, clean_db_loop
+from pogom.models import init_database, create_tables, drop_tables, SpawnPoint, db_updater, clean_db_loop, pokemon_index_loop, \
+    seen_stats_loop, partition_tables
 from pogom.webhook import wh_updater
 
 from pogom.proxy import check_proxies, proxies_refresher
@@ -200,6 +201,11 @@ def main():
         elif os.path.isfile(args.db):
             os.remove(args.db)
     create_tables(db)
+    if args.db_partitions:
+        if args.db_type == 'mysql':
+            partition_tables(db)
+        else:
+            log.warning('Partitioned tables need MySQL, ignoring --db-partitions.')
 
     app.set_current_location(position)
 
@@ -218,8 +224,18 @@ def main():
     # DB Updates
     db_updates_queue = Queue()
 
-    # Thread(s) to process database updates.
-    for i in range(args.db_threads):
+    # Thread to keep the seen statistics up to date with the stored sightings.
+    t = Thread(target=seen_stats_loop, name='seen-stats', args=(args,))
+    t.daemon = True
+    t.start()
+
+    # Thread(s) to process database updates. SQLite takes one writer at a
+    # time, so it gets a single thread batching the queue.
+    db_threads = args.db_threads
+    if args.db_type == 'sqlite' and db_threads > 1:
+        log.info('SQLite has a single writer, ignoring --db-threads.')
+        db_threads = 1
+    for i in range(db_threads):
         log.debug('Starting db-updater worker thread %d', i)
         t = Thread(target=db_updater, name='db-updater-{}'.format(i), args=(args, db_updates_queue))
         t.daemon = True
@@ -231,6 +247,12 @@ def main():
         t.daemon = True
         t.start()
 
+    # In-memory index of active Pokemon for the web server.
+    if not args.no_server and args.pokemon_index_refresh > 0:
+        t = Thread(target=pokemon_index_loop, name='pokemon-index', args=(args,))
+        t.daemon = True
+        t.start()
+
     # WH Updates.
     wh_updates_queue = Queue()
 
@@ -260,7 +282,7 @@ def main():
         if args.spawnpoint_scanning and args.spawnpoint_scanning != 'nofile' and args.dump_spawnpoints:
             with open(args.spawnpoint_scanning, 'w+') as file:
                 log.info('Saving spawn points to %s', args.spawnpoint_scanning)
-                spawns = Pokemon.get_spawnpoints_in_hex(position, args.step_limit)
+                spawns = SpawnPoint.get_spawnpoints_in_hex(position, args.step_limit)
                 file.write(json.dumps(spawns))
                 log.info('Finished exporting spawn points')
 
@@ -284,6 +306,9 @@ def main():
     config['ROOT_PATH'] = app.root_path
     config['GMAPS_KEY'] = args.gmaps_key
 
+    # Build the localized species and move tables before serving requests.
+    build_species_tables()
+
     if args.no_server:
         # This loop allows for ctrl-c interupts to work since flask won't be holding the program open.
         while search_thread.is_alive():
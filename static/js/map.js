@@ -57,6 +57,9 @@ var selectedStyle = 'light'
 
 var updateWorker
 var lastUpdateTime
+var stream
+var streamOpen = false
+var streamUnavailable = false
 
 var gymTypes = ['Uncontested', 'Mystic', 'Valor', 'Instinct']
 var gymPrestige = [2000, 4000, 8000, 12000, 16000, 20000, 30000, 40000, 50000]
@@ -175,7 +178,11 @@ function initMap () { // eslint-disable-line no-unused-vars
   })
 
   map.setMapTypeId(Store.get('map_style'))
-  map.addListener('idle', updateMap)
+  map.addListener('idle', function () {
+    if (!openStream()) {
+      updateMap()
+    }
+  })
 
   map.addListener('zoom_changed', function () {
     if (storeZoom === true) {
@@ -1241,6 +1248,88 @@ function updateMap () {
   })
 }
 
+function pollMap () {
+  // While the stream is open, only poll now and then for the changes it
+  // doesn't push (spawnpoints, other instances writing to the db).
+  if (!streamOpen || Date.now() - lastUpdateTime > 30000) {
+    updateMap()
+  }
+}
+
+function openStream () {
+  if (!window.EventSource || streamUnavailable) {
+    return false
+  }
+
+  if (stream) {
+    stream.close()
+  }
+  streamOpen = false
+
+  var bounds = map.getBounds()
+  var swPoint = bounds.getSouthWest()
+  var nePoint = bounds.getNorthEast()
+  var source = new EventSource('stream?' + $.param({
+    'swLat': swPoint.lat(),
+    'swLng': swPoint.lng(),
+    'neLat': nePoint.lat(),
+    'neLng': nePoint.lng()
+  }))
+  stream = source
+
+  source.addEventListener('open', function () {
+    streamOpen = true
+    // Catch up with whatever changed while (re)connecting.
+    updateMap()
+  })
+
+  source.addEventListener('error', function () {
+    streamOpen = false
+    if (source.readyState === EventSource.CLOSED) {
+      // Stream disabled or unsupported by a proxy, stick to polling.
+      streamUnavailable = true
+      updateMap()
+    }
+  })
+
+  source.addEventListener('pokemon', function (e) {
+    $.each(JSON.parse(e.data), processPokemons)
+  })
+
+  source.addEventListener('expired', function (e) {
+    $.each(JSON.parse(e.data), function (i, item) {
+      if (item['encounter_id'] in mapData.pokemons) {
+        mapData.pokemons[item['encounter_id']]['disappear_time'] = 0
+      }
+    })
+    clearStaleMarkers()
+  })
+
+  source.addEventListener('pokestops', function (e) {
+    $.each(JSON.parse(e.data), processPokestops)
+    updatePokestops()
+  })
+
+  source.addEventListener('gyms', function (e) {
+    $.each(JSON.parse(e.data), function (i, item) {
+      var gym = mapData.gyms[item['gym_id']]
+      if (gym) {
+        // Gym scans and gym detail scans each only send part of a gym.
+        processGyms(i, $.extend({}, gym, item))
+      } else if (item['team_id'] !== undefined) {
+        processGyms(i, $.extend({'name': null, 'pokemon': []}, item))
+      }
+    })
+  })
+
+  source.addEventListener('scanned', function (e) {
+    $.each(JSON.parse(e.data), processScanned)
+    updateScanned()
+  })
+
+  return true
+}
+
 function drawScanPath (points) { // eslint-disable-line no-unused-vars
   var scanPathPoints = []
   $.each(points, function (idx, point) {
@@ -1952,7 +2041,7 @@ $(function () {
 
   // run interval timers to regularly update map and timediffs
   window.setInterval(updateLabelDiffTime, 1000)
-  window.setInterval(updateMap, 5000)
+  window.setInterval(pollMap, 5000)
   window.setInterval(updateGeoLocation, 1000)
 
   createUpdateWorker()
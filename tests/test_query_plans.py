@@ -0,0 +1,175 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Query plans of the statements the map's layer getters run for a poll,
+# against a seeded database. Runs on a temporary SQLite database, or on MySQL
+# when POGOMAP_DB_TYPE=mysql and the other POGOMAP_DB_* variables point to a
+# scratch database, whose tables are created, filled and dropped.
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+
+from datetime import datetime, timedelta
+
+from flask import Flask
+
+# Viewport of the polls, and the one the map showed before it moved.
+VIEW = (40.4, -73.6, 40.5, -73.5)
+OLD_VIEW = (40.38, -73.62, 40.48, -73.52)
+
+models = None
+db = None
+tmpdir = None
+
+
+def setup_module():
+    global models, db, tmpdir
+
+    # pogom reads its arguments on import, keep a local config.ini out of it.
+    tmpdir = tempfile.mkdtemp()
+    config_file = os.path.join(tmpdir, 'config.ini')
+    open(config_file, 'w').close()
+    sys.argv = ['nosetests', '-cf', config_file, '-k', 'test', '-os', '-l', '40.45,-73.55',
+                '-D', os.path.join(tmpdir, 'pogom.db')]
+
+    from pogom import models
+    db = models.init_database(Flask(__name__))
+    if models.args.db_type == 'mysql':
+        models.drop_tables(db)
+    models.create_tables(db)
+    seed(datetime.utcnow())
+
+
+def teardown_module():
+    if models.args.db_type == 'mysql':
+        models.drop_tables(db)
+    db.close()
+    shutil.rmtree(tmpdir)
+
+
+# A week of despawned Pokemon with a few active ones, and forts, scanned
+# locations and spawnpoints spread over a degree square around the viewport,
+# mostly not updated lately.
+def seed(now):
+    rnd = random.Random(1)
+
+    def spot():
+        return {'latitude': 40 + rnd.random(), 'longitude': -74 + rnd.random()}
+
+    def ago(seconds):
+        return now - timedelta(seconds=rnd.randint(-1800, seconds))
+
+    pokemons = []
+    for i in range(20000):
+        p = spot()
+        p.update({'encounter_id': 'e{}'.format(i), 'spawnpoint_id': 's{}'.format(i % 5000),
+                  'pokemon_id': 1 + i % 150, 'disappear_time': ago(7 * 86400)})
+        p['last_modified'] = p['disappear_time'] - timedelta(minutes=15)
+        pokemons.append(p)
+
+    pokestops = []
+    gyms = []
+    for i in range(5000):
+        p = spot()
+        p.update({'pokestop_id': 'p{}'.format(i), 'enabled': True, 'last_modified': ago(86400),
+                  'last_updated': ago(86400), 'active_fort_modifier': None, 'lure_expiration': None})
+        if i % 20 == 0:
+            p.update({'active_fort_modifier': '501', 'lure_expiration': ago(1800)})
+        pokestops.append(p)
+
+        if i % 4 == 0:
+            g = spot()
+            g.update({'gym_id': 'g{}'.format(i), 'team_id': i % 4, 'guard_pokemon_id': 1,
+                      'gym_points': 0, 'enabled': True, 'last_modified': ago(86400),
+                      'last_scanned': ago(86400)})
+            gyms.append(g)
+
+    locations = []
+    spawnpoints = []
+    for i in range(5000):
+        s = spot()
+        s.update({'cellid': 'c{}'.format(i), 'last_modified': ago(86400)})
+        locations.append(s)
+
+        s = spot()
+        s.update({'id': 's{}'.format(i), 'last_scanned': ago(86400), 'latest_seen': 0,
+                  'earliest_unseen': 0})
+        spawnpoints.append(s)
+
+    with db.atomic():
+        for model, rows in ((models.Pokemon, pokemons), (models.Pokestop, pokestops),
+                            (models.Gym, gyms), (models.ScannedLocation, locations),
+                            (models.SpawnPoint, spawnpoints)):
+            for i in range(0, len(rows), 100):
+                model.insert_many(rows[i:i + 100]).execute()
+
+    if models.args.db_type == 'mysql':
+        db.execute_sql('ANALYZE TABLE pokemon, pokestop, gym, scannedlocation, spawnpoint')
+    else:
+        db.execute_sql('ANALYZE')
+
+
+# The SELECT statements the layer getters run, as (sql, params), for the first
+# poll of a viewport and for the polls after it, with and without a move.
+def map_queries():
+    executed = []
+    execute_sql = db.execute_sql
+
+    def record(sql, params=None, *args, **kwargs):
+        if sql.startswith('SELECT') and sql not in [s for s, p in executed]:
+            executed.append((sql, params))
+        return execute_sql(sql, params, *args, **kwargs)
+
+    since = datetime.utcnow() - timedelta(seconds=10)
+    timestamp = (since - datetime(1970, 1, 1)).total_seconds() * 1000
+
+    db.execute_sql = record
+    try:
+        for poll in (VIEW, VIEW + (timestamp,), VIEW + (timestamp,) + OLD_VIEW, VIEW + (0,) + OLD_VIEW):
+            list(models.Pokemon.iter_active(*poll))
+            models.Pokestop.get_stops(*poll)
+            models.Pokestop.get_stops(*poll, lured=True)
+            models.Gym.get_gyms(*poll)
+            models.ScannedLocation.get_recent(*poll)
+            models.SpawnPoint.get_spawnpoints(*poll)
+    finally:
+        del db.execute_sql
+
+    return executed
+
+
+# Returns the plan of a statement, as a string, and whether it reads a whole
+# table. Scanning a covering index is fine, the table isn't read.
+def explain(sql, params):
+    if models.args.db_type == 'mysql':
+        cursor = db.execute_sql('EXPLAIN ' + sql, params)
+        columns = [c[0] for c in cursor.description]
+        plan = [dict(zip(columns, row)) for row in cursor.fetchall()]
+        covered = [row['type'] == 'index' and 'Using index' in (row['Extra'] or '') for row in plan]
+        full_scan = any(row['type'] in ('ALL', 'index') and not c for row, c in zip(plan, covered))
+        plan = ', '.join('{} {} via {}'.format(row['table'], row['type'], row['key']) for row in plan)
+    else:
+        rows = db.execute_sql('EXPLAIN QUERY PLAN ' + sql, params).fetchall()
+        full_scan = any(row[-1].startswith('SCAN') and 'COVERING INDEX' not in row[-1]
+                        for row in rows)
+        plan = ', '.join(row[-1] for row in rows)
+
+    return plan, full_scan
+
+
+def check_plan(sql, params):
+    plan, full_scan = explain(sql, params)
+    assert not full_scan, 'Full scan in {}\nfor {}'.format(plan, sql)
+
+
+def test_map_query_plans():
+    queries = map_queries()
+    tables = ('pokemon', 'pokestop', 'gym', 'scannedlocation', 'spawnpoint')
+    assert all(any('FROM "{}"'.format(t) in s or 'FROM `{}`'.format(t) in s for s, p in queries)
+               for t in tables)
+
+    for sql, params in queries:
+        yield check_plan, sql, params
@@ -0,0 +1,93 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# /raw_data responses decoded the way the map reads them, streamed, from the
+# shared cache and gzipped. Runs on a temporary SQLite database, or on the
+# MySQL scratch database set up through the POGOMAP_DB_* variables.
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import zlib
+
+from datetime import datetime
+from threading import Event
+
+BOX = 'swLat=40.4&swLng=-73.6&neLat=40.5&neLng=-73.5'
+LAYERS = '&pokemon=false&pokestops=false&scanned=false&gyms=true'
+
+models = None
+app = None
+db = None
+tmpdir = None
+
+
+def setup_module():
+    global models, app, db, tmpdir
+
+    # pogom reads its arguments on import, keep a local config.ini out of it.
+    tmpdir = tempfile.mkdtemp()
+    config_file = os.path.join(tmpdir, 'config.ini')
+    open(config_file, 'w').close()
+    sys.argv = ['nosetests', '-cf', config_file, '-k', 'test', '-os', '-l', '40.45,-73.55',
+                '-D', os.path.join(tmpdir, 'pogom.db')]
+
+    from pogom import models
+    from pogom.app import Pogom
+    # Another test module may have imported pogom with its own database.
+    models.args.db = os.path.join(tmpdir, 'pogom.db')
+    app = Pogom(__name__)
+    app.set_current_location((40.45, -73.55, 0))
+    app.set_heartbeat_control([0])
+    app.set_search_control(Event())
+    db = models.init_database(app)
+    if models.args.db_type == 'mysql':
+        models.drop_tables(db)
+    models.create_tables(db)
+
+    now = datetime.utcnow()
+    models.Gym.insert_many([
+        {'gym_id': 'g{}'.format(i), 'team_id': i % 4, 'guard_pokemon_id': 1 + i,
+         'gym_points': 1000 * i, 'enabled': True, 'latitude': 40.45 + i * 0.001,
+         'longitude': -73.55, 'last_modified': now, 'last_scanned': now}
+        for i in range(3)]).execute()
+
+
+def teardown_module():
+    models.response_cache.set_ttl(models.args.raw_data_cache)
+    if models.args.db_type == 'mysql':
+        models.drop_tables(db)
+    db.close()
+    shutil.rmtree(tmpdir)
+
+
+def raw_data(cache_ttl, gzip=False):
+    models.response_cache.set_ttl(cache_ttl)
+    headers = {'Accept-Encoding': 'gzip'} if gzip else {}
+    response = app.test_client().get('/raw_data?' + BOX + LAYERS, headers=headers)
+    assert response.status_code == 200, response.data
+    data = response.data
+    if response.headers.get('Content-Encoding') == 'gzip':
+        data = zlib.decompress(data, zlib.MAX_WBITS | 16)
+    return json.loads(data)
+
+
+def check_gyms(cache_ttl, gzip):
+    gyms = raw_data(cache_ttl, gzip)['gyms']
+    assert isinstance(gyms, dict), gyms
+    assert sorted(gyms) == ['g0', 'g1', 'g2']
+    for gym_id, gym in gyms.iteritems():
+        i = int(gym_id[1:])
+        assert gym['gym_id'] == gym_id
+        assert gym['team_id'] == i % 4
+        assert gym['guard_pokemon_id'] == 1 + i
+        assert gym['gym_points'] == 1000 * i
+        assert gym['pokemon'] == []
+
+
+def test_gyms():
+    for cache_ttl in (0, 30):
+        for gzip in (False, True):
+            yield check_gyms, cache_ttl, gzip